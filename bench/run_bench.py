@@ -0,0 +1,437 @@
+"""
+离线基准测试：本地 fixture 站点模拟小红书搜索页、笔记页与创作者发布页，
+通过 CDP 驱动本地无头 Chromium 调用各工具，输出每个工具的 p50/p95 延迟与 Playwright 往返次数
+
+浏览器内所有 *.xiaohongshu.com 请求都被路由到本地 fixture 服务，图片 CDN 返回占位图，其余外部请求直接拦截，
+全程不访问真实平台。
+
+局限：fixture 通过 context.route 接管请求，而 Playwright 的路由会关闭标签页的 HTTP 缓存，
+线上（只用 Network.setBlockedURLs 拦截资源、缓存开启）不是这样运行的。因此这里测得的是无缓存下的耗时，
+缓存命中相关的回退（如 ResourceBlocker 报告的 transferred_bytes / cached_responses）不在测量范围内。
+没有改用 --host-resolver-rules 把域名解析到本地，是因为真实地址均为 HTTPS，而 fixture 服务只提供 HTTP。
+
+用法:
+    python bench/run_bench.py
+    python bench/run_bench.py --rounds 20 --tools search_articles,view_article_comments
+    python bench/run_bench.py --json baseline.json
+    python bench/run_bench.py --baseline baseline.json --tolerance 0.2   # p95 或往返次数回退超过 20% 时退出码为 1
+"""
+import argparse
+import asyncio
+import json
+import re
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse
+
+from aiohttp import web
+from playwright._impl._connection import Connection
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import mcp_server_playwright as server  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+SEARCH_PAGE_SIZE = 20
+COMMENT_PAGE_SIZE = 10
+SUB_PREVIEW = 1  # 评论分页接口中每条父评论附带的回复数，其余通过“展开更多回复”加载
+
+
+def placeholder_png(width: int = 8, height: int = 8) -> bytes:
+    """生成纯色 PNG，用作图片 CDN 的占位图与发布图文时上传的配图"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    raw = b"".join(b"\x00" + b"\xee\x88\x88" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FixtureSite:
+    """
+    本地 fixture 服务：按录制的 HTML/JSON 返回页面与接口数据
+    路径以站点前缀区分：/www/... 对应 www.xiaohongshu.com，/creator/... 对应 creator.xiaohongshu.com
+    """
+
+    def __init__(self, latency_ms: float = 80):
+        self.latency_ms = latency_ms  # 模拟接口的网络延迟
+        self.search_items = self._load("search_notes.json")["items"]
+        self.feed = self._load("feed.json")
+        self.comments = self._load("comment_page.json")["comments"]
+        self.requests = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    @staticmethod
+    def _load(name: str) -> Dict[str, Any]:
+        return json.loads((FIXTURES / "api" / name).read_text(encoding="utf-8"))["data"]
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+    @staticmethod
+    def _page(name: str):
+        async def handler(_: web.Request) -> web.FileResponse:
+            return web.FileResponse(FIXTURES / name, headers={"Content-Type": "text/html; charset=utf-8"})
+        return handler
+
+    async def note_page(self, request: web.Request) -> web.Response:
+        # 笔记页内嵌的初始数据按请求的笔记 id 渲染
+        html = (FIXTURES / "note.html").read_text(encoding="utf-8")
+        return web.Response(text=html.replace("__NOTE_ID__", request.match_info["note_id"]),
+                            content_type="text/html", charset="utf-8")
+
+    @staticmethod
+    def _ok(data: Dict[str, Any]) -> web.Response:
+        return web.json_response({"code": 0, "success": True, "msg": "成功", "data": data})
+
+    async def search_notes(self, request: web.Request) -> web.Response:
+        await self._delay()
+        body = await request.json()
+        start = (int(body.get("page") or 1) - 1) * SEARCH_PAGE_SIZE
+        items = self.search_items[start:start + SEARCH_PAGE_SIZE]
+        return self._ok({"items": items, "has_more": start + SEARCH_PAGE_SIZE < len(self.search_items)})
+
+    async def feed_api(self, request: web.Request) -> web.Response:
+        await self._delay()
+        note_id = (await request.json()).get("source_note_id") or ""
+        data = json.loads(json.dumps(self.feed))
+        data["items"][0]["id"] = note_id
+        data["items"][0]["note_card"]["note_id"] = note_id
+        return self._ok(data)
+
+    async def comment_page(self, request: web.Request) -> web.Response:
+        await self._delay()
+        start = int(request.query.get("cursor") or 0)
+        end = start + COMMENT_PAGE_SIZE
+        comments = []
+        for raw in self.comments[start:end]:
+            subs = raw["sub_comments"]
+            comments.append({
+                **raw,
+                "sub_comments": subs[:SUB_PREVIEW],
+                "sub_comment_has_more": len(subs) > SUB_PREVIEW,
+                "sub_comment_cursor": str(SUB_PREVIEW),
+            })
+        has_more = end < len(self.comments)
+        return self._ok({"comments": comments, "cursor": str(end) if has_more else "", "has_more": has_more})
+
+    async def sub_comment_page(self, request: web.Request) -> web.Response:
+        await self._delay()
+        root = next((c for c in self.comments if c["id"] == request.query.get("root_comment_id")), None)
+        subs = root["sub_comments"] if root else []
+        start = int(request.query.get("cursor") or 0)
+        end = start + int(request.query.get("num") or 3)
+        return self._ok({"comments": subs[start:end], "cursor": str(end), "has_more": end < len(subs)})
+
+    async def post_comment(self, request: web.Request) -> web.Response:
+        await self._delay()
+        body = await request.json()
+        return self._ok({"comment": {
+            "id": f"bench{int(time.time() * 1000)}", "content": body.get("content") or "",
+            "create_time": int(time.time() * 1000), "ip_location": "本地", "like_count": "0",
+            "user_info": {"user_id": "bench", "nickname": "bench"}, "sub_comments": [],
+        }})
+
+    async def publish(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return self._ok({"id": f"bench{int(time.time() * 1000)}"})
+
+    async def user_me(self, _: web.Request) -> web.Response:
+        return self._ok({"user_id": "bench", "nickname": "bench", "guest": False})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/www/search_result", self._page("search_result.html"))
+        app.router.add_get("/www/explore/{note_id}", self.note_page)
+        app.router.add_post("/www/api/sns/web/v1/search/notes", self.search_notes)
+        app.router.add_post("/www/api/sns/web/v1/feed", self.feed_api)
+        app.router.add_get("/www/api/sns/web/v2/comment/page", self.comment_page)
+        app.router.add_get("/www/api/sns/web/v2/comment/sub/page", self.sub_comment_page)
+        app.router.add_post("/www/api/sns/web/v1/comment/post", self.post_comment)
+        app.router.add_get("/www/api/sns/web/v2/user/me", self.user_me)
+        app.router.add_get("/creator/publish/publish", self._page("publish.html"))
+        app.router.add_post("/creator/api/galaxy/creator/note/publish", self.publish)
+        app.router.add_get("/{site}/{tail:.*}", self._page("home.html"))
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        port = free_port()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def local_url(self, url: str) -> Optional[str]:
+        """把小红书页面/接口地址映射到 fixture 服务，非小红书地址返回 None"""
+        parsed = urlparse(url)
+        host = parsed.hostname or ""
+        if not host.endswith("xiaohongshu.com") or re.match(r"(apm-fe|t2)\.", host):
+            return None
+        site = "creator" if host.startswith("creator.") else "www"
+        return f"{self.base_url}/{site}{parsed.path or '/'}" + (f"?{parsed.query}" if parsed.query else "")
+
+    async def route(self, route):
+        """浏览器上下文路由：小红书域名转发到 fixture 服务，图片 CDN 返回占位图，其余外部请求拦截"""
+        host = urlparse(route.request.url).hostname or ""
+        local = self.local_url(route.request.url)
+        if host.endswith("xhscdn.com") and route.request.resource_type == "image":
+            await route.fulfill(status=200, content_type="image/png", body=PLACEHOLDER)
+        elif local:
+            response = await route.fetch(url=local)
+            await route.fulfill(response=response)
+        else:
+            await route.abort()
+
+
+PLACEHOLDER = placeholder_png()
+
+
+class BenchBrowser(server.XiaohongshuBrowser):
+    """上下文请求接口不经过页面路由，headless 获取与登录校验同样改写到 fixture 服务，保证全程离线"""
+
+    def __init__(self, site: FixtureSite, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.site = site
+
+    async def fetch_html(self, url: str, timeout: float = 10000) -> tuple[int, str]:
+        local = self.site.local_url(url)
+        if not local:
+            raise RuntimeError(f"基准测试不访问外部地址: {url}")
+        return await super().fetch_html(local, timeout)
+
+    async def _fetch_login_user(self, url: str = server.LOGIN_USER_API) -> bool:
+        return await super()._fetch_login_user(self.site.local_url(url))
+
+
+class RpcCounter:
+    """统计 Playwright 客户端发往浏览器驱动的协议消息数，即每次工具调用的往返次数"""
+
+    def __init__(self):
+        self.count = 0
+        self._original = Connection._send_message_to_server
+
+    def install(self):
+        counter = self
+
+        def send(connection, *args, **kwargs):
+            counter.count += 1
+            return counter._original(connection, *args, **kwargs)
+
+        Connection._send_message_to_server = send
+
+    def uninstall(self):
+        Connection._send_message_to_server = self._original
+
+
+async def launch_chromium(executable: str, port: int, user_data_dir: Path) -> asyncio.subprocess.Process:
+    """以远程调试端口启动本地无头 Chromium，服务端与线上一样通过 CDP 连接"""
+    process = await asyncio.create_subprocess_exec(
+        executable, "--headless=new", f"--remote-debugging-port={port}", f"--user-data-dir={user_data_dir}",
+        "--no-first-run", "--no-default-browser-check", "--disable-gpu", "--no-sandbox", "about:blank",
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline and process.returncode is None:
+        if (await server.cdp_prober.probe(f"http://127.0.0.1:{port}"))["up"]:
+            return process
+        await asyncio.sleep(0.2)
+    if process.returncode is not None:
+        raise RuntimeError(f"本地 Chromium 启动失败，退出码 {process.returncode}: {executable}")
+    process.kill()
+    raise RuntimeError("本地 Chromium 启动超时")
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def note_url(site: FixtureSite, index: int) -> str:
+    item = site.search_items[index % len(site.search_items)]
+    return server.note_link(item["id"], item["xsec_token"])
+
+
+def bench_cases(site: FixtureSite, image: Path) -> Dict[str, Any]:
+    """工具名 -> (调用工厂, 是否为写操作)；读操作均跳过缓存，测的是实际抓取路径"""
+    return {
+        "search_articles": (lambda i: server.search_articles("周末徒步", max_results=40), False),
+        "get_article_content": (lambda i: server.get_article_content(note_url(site, i), force_refresh=True), False),
+        "get_article_content_tab": (
+            lambda i: server.get_article_content(note_url(site, i), force_refresh=True, mode="tab"),
+            False,
+        ),
+        "view_article_comments": (
+            lambda i: server.view_article_comments(note_url(site, i), limit=20, max_expand=3, force_refresh=True),
+            False,
+        ),
+        "post_comment": (lambda i: server.post_comment(note_url(site, i), f"基准测试评论 {i}"), True),
+        "post_note": (
+            lambda i: server.post_note(f"基准测试 {i}", "正文内容", abstract="要点一\n要点二", tags=["周末徒步"]),
+            True,
+        ),
+        "post_note_image": (
+            lambda i: server.post_note(f"基准测试图文 {i}", "正文内容", tags=["周末徒步"], image=[str(image)]),
+            True,
+        ),
+    }
+
+
+async def prepare_server(cdp_url: str, workdir: Path, site: FixtureSite) -> server.XiaohongshuBrowser:
+    """把服务模块的浏览器、缓存、限流与图片缓存替换为基准测试专用的实例"""
+    browser = BenchBrowser(site, cdp_url, capture_api=True)
+    browser.auth_file = workdir / "auth.json"
+    server.browsers.clear()
+    server.browsers["bench"] = browser
+    server.scheduler = server.BrowserScheduler(server.browsers)
+    server.note_cache = server.NoteCache(workdir / "cache.sqlite3")
+    # 基准测试只关心工具本身的耗时，放开写操作限流
+    server.rate_limiter = server.RateLimiter({"comment": (10_000, 0.001), "note": (10_000, 0.001)})
+    server.image_fetcher = server.ImageFetcher(
+        workdir / "image_cache", preprocessor=server.ImagePreprocessor(workdir / "image_cache" / "processed"),
+    )
+    await browser._ensure_browser()
+    await browser.context.route("**/*", site.route)
+    await browser.context.add_cookies([{
+        "name": server.LOGIN_COOKIE, "value": "bench", "domain": ".xiaohongshu.com", "path": "/",
+        "expires": time.time() + 86400,
+    }])
+    return browser
+
+
+async def run(args) -> int:
+    site = FixtureSite(latency_ms=args.latency_ms)
+    await site.start()
+    workdir = Path(tempfile.mkdtemp(prefix="xhs_bench_"))
+    image = workdir / "upload.png"
+    image.write_bytes(placeholder_png(64, 64))
+    port = free_port()
+    chromium = None
+    counter = RpcCounter()
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        playwright = await server.shared_playwright()
+        chromium = await launch_chromium(args.chromium or playwright.chromium.executable_path, port,
+                                         workdir / "profile")
+        await prepare_server(f"http://127.0.0.1:{port}", workdir, site)
+        cases = bench_cases(site, image)
+        selected = args.tools.split(",") if args.tools else list(cases)
+        unknown = [name for name in selected if name not in cases]
+        if unknown:
+            print(f"未知工具: {', '.join(unknown)}，可选: {', '.join(cases)}")
+            return 2
+        counter.install()
+        for name in selected:
+            factory, is_write = cases[name]
+            rounds = args.write_rounds if is_write else args.rounds
+            latencies, rpcs, failures = [], [], 0
+            for i in range(args.warmup + rounds):
+                before = counter.count
+                start = time.perf_counter()
+                result = await factory(i)
+                elapsed = (time.perf_counter() - start) * 1000
+                if i < args.warmup:
+                    continue
+                if not result.get("success"):
+                    failures += 1
+                    print(f"{name} 第 {i} 次调用失败: {result.get('message')}")
+                latencies.append(elapsed)
+                rpcs.append(counter.count - before)
+            results[name] = {
+                "calls": len(latencies),
+                "failures": failures,
+                "p50_ms": round(percentile(latencies, 0.5), 1),
+                "p95_ms": round(percentile(latencies, 0.95), 1),
+                "mean_ms": round(sum(latencies) / len(latencies), 1),
+                "rpc_per_call": round(sum(rpcs) / len(rpcs), 1),
+            }
+            print(f"{name} 完成: {results[name]}")
+    finally:
+        counter.uninstall()
+        await server.clean_browsers()
+        if chromium and chromium.returncode is None:
+            chromium.kill()
+            await chromium.wait()
+        await site.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps({"tools": results, "phases": server.metrics.snapshot(),
+                                               "readiness": server.readiness.status()},
+                                              ensure_ascii=False, indent=2))
+        print(f"结果已写入 {args.json}")
+    if args.baseline:
+        return compare(results, json.loads(Path(args.baseline).read_text())["tools"], args.tolerance)
+    return 0
+
+
+def report(results: Dict[str, Dict[str, Any]]):
+    print()
+    print(f"{'工具':<24}{'次数':>6}{'失败':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'均值(ms)':>10}{'往返/次':>9}")
+    for name, row in results.items():
+        print(f"{name:<24}{row['calls']:>6}{row['failures']:>6}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['mean_ms']:>10}{row['rpc_per_call']:>9}")
+    print()
+    print("各阶段耗时 p50/p95（ms）：")
+    for tool, by_browser in server.metrics.snapshot().items():
+        phases = by_browser.get("bench") or next(iter(by_browser.values()))
+        line = ", ".join(f"{phase} {row['p50_ms']}/{row['p95_ms']}" for phase, row in phases.items())
+        print(f"  {tool}: {line}")
+    print()
+    print("就绪等待 平均/最大耗时（ms），相对原固定等待平均节省：")
+    for name, row in server.readiness.status().items():
+        saved = f"，节省 {row['avg_saved_ms']}" if row["avg_saved_ms"] is not None else ""
+        print(f"  {name}: {row['avg_ms']}/{row['max_ms']}，超时 {row['timeouts']}{saved}")
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> int:
+    """与基线对比 p95 延迟与往返次数，任一工具回退超过容忍比例时返回 1"""
+    regressions = []
+    for name, row in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ("p95_ms", "rpc_per_call"):
+            if base[key] and row[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {base[key]} -> {row[key]}")
+    if regressions:
+        print("性能回退：")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("未发现超过容忍范围的性能回退")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="小红书 MCP 工具离线基准测试")
+    parser.add_argument("--rounds", type=int, default=10, help="只读工具每个的调用次数")
+    parser.add_argument("--write-rounds", type=int, default=3, help="写操作（评论/发布）每个的调用次数")
+    parser.add_argument("--warmup", type=int, default=1, help="不计入统计的预热调用次数")
+    parser.add_argument("--tools", help="逗号分隔的工具名，默认全部")
+    parser.add_argument("--latency-ms", type=float, default=80, help="fixture 接口模拟的网络延迟")
+    parser.add_argument("--chromium", help="Chromium 可执行文件路径，默认使用 Playwright 自带的 Chromium")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，可作为之后对比的基线")
+    parser.add_argument("--baseline", help="与之对比的基线 JSON 文件")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的回退比例")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
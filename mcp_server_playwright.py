@@ -1,46 +1,1114 @@
+import asyncio
 import atexit
+import base64
+import functools
+import hashlib
+import json
 import mimetypes
 import os
 import pathlib
 import random
+import re
+import shutil
+import sqlite3
+import time
+import uuid
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
 from pathlib import Path
 from typing import Dict, Any, Optional, Union
-from urllib.parse import urlparse, unquote
+from urllib.parse import urlparse, unquote, quote
 
 import aiohttp
 import filetype
-from mcp.server.fastmcp.server import FastMCP
+from mcp.server.fastmcp.server import FastMCP, Context
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
 from playwright.async_api import async_playwright, Page, Browser, BrowserContext, Playwright, \
     TimeoutError as PlaywrightTimeoutError
 from playwright_stealth import Stealth
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装 Pillow 时跳过图片预处理
+    Image = None
+
+# 小红书网页端的会话 cookie，游客访问也会下发，只作为是否需要查询用户接口的初筛
+LOGIN_COOKIE = "web_session"
+# 当前用户接口，已登录时返回用户信息，游客会话返回 guest=true
+LOGIN_USER_API = "https://edith.xiaohongshu.com/api/sns/web/v2/user/me"
+
+
+_shared_playwright: Optional[Playwright] = None
+_shared_playwright_lock = asyncio.Lock()
+
+
+async def shared_playwright() -> Playwright:
+    """所有 CDP 连接共用一个 Playwright 驱动进程"""
+    global _shared_playwright
+    async with _shared_playwright_lock:
+        if _shared_playwright is None:
+            stealth = Stealth(
+                navigator_user_agent_override="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+                , navigator_languages_override=("zh-CN", 'zh')
+            )
+            _shared_playwright = await stealth.use_async(async_playwright()).__aenter__()
+        return _shared_playwright
+
+
+async def stop_shared_playwright():
+    global _shared_playwright
+    if _shared_playwright is not None:
+        playwright, _shared_playwright = _shared_playwright, None
+        await playwright.stop()
+
+
+@dataclass
+class RecyclePolicy:
+    """标签页回收阈值，任一项达到即在两次请求之间关闭并补建该页面；0 表示不限制"""
+    max_navigations: int = 200  # 主框架导航次数
+    max_heap_mb: float = 300  # JS 堆已用大小
+    max_dom_nodes: int = 30000  # DOM 节点数（含尚未回收的游离节点）
+
+
+class PagePool:
+    """
+    同一浏览器上下文内的标签页池，按租借/归还复用页面，避免并发请求争用同一个页面；
+    页面归还后在后台通过 CDP 采样 JS 堆与 DOM 节点数，超过回收策略阈值的页面关闭并补建新页面
+    """
+
+    def __init__(self, context: BrowserContext, size: int = 3, acquire_timeout: float = 30,
+                 policy: Optional[RecyclePolicy] = None):
+        self.context = context
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.policy = policy or RecyclePolicy()
+        self._idle: list[Page] = []
+        self._in_use: set[Page] = set()
+        self._checking: set[Page] = set()  # 已归还、正在采样指标的页面
+        self._creating = 0
+        self._waiting = 0
+        self._cond = asyncio.Condition()
+        self._meta: Dict[Page, Dict[str, Any]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {
+            "leases": 0,  # 租借次数
+            "waits": 0,  # 因池满而等待的次数
+            "timeouts": 0,  # 等待超时（池耗尽）次数
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "samples": 0,  # 指标采样次数
+            "heap_mb_max": 0.0,  # 采样到的单页面 JS 堆峰值
+            "dom_nodes_max": 0,
+            "recycled": {"navigations": 0, "heap": 0, "dom_nodes": 0},  # 按原因统计的回收次数
+            "interrupted": 0,  # 调用被取消或超时而在后台重置的租借次数
+        }
+
+    def _total(self) -> int:
+        return len(self._idle) + len(self._in_use) + len(self._checking) + self._creating
+
+    async def acquire(self, timeout: Optional[float] = None) -> Page:
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.perf_counter()
+        page = None
+        async with self._cond:
+            waited = False
+            while True:
+                # 优先复用空闲页面，顺带丢弃已关闭的页面
+                while self._idle and page is None:
+                    candidate = self._idle.pop()
+                    if not candidate.is_closed():
+                        page = candidate
+                if page is not None:
+                    self._in_use.add(page)
+                    break
+                if self._total() < self.size:
+                    self._creating += 1
+                    break
+                # 池已满，等待其他请求归还页面
+                if not waited:
+                    waited = True
+                    self.stats["waits"] += 1
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise RuntimeError(f"页面池已耗尽，等待 {timeout}s 仍无可用页面")
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(self._cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiting -= 1
+
+        if page is None:
+            page = await self._create_page(self._in_use)
+
+        self._meta[page]["leases"] += 1
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.stats["leases"] += 1
+        self.stats["wait_ms_total"] += wait_ms
+        self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+        return page
+
+    async def _create_page(self, target: Union[set, list]) -> Page:
+        """新建页面并放入 target（租借中或空闲）；调用前已在锁内占用 _creating 名额"""
+        try:
+            page = await self.context.new_page()
+        except Exception:
+            async with self._cond:
+                self._creating -= 1
+                self._cond.notify()
+            raise
+        self._meta[page] = {"navigations": 0, "leases": 0, "heap_mb": 0.0, "dom_nodes": 0,
+                            "created": time.monotonic(), "session": None}
+        page.on("close", lambda p=page: self._forget(p))
+        page.on("framenavigated", lambda frame, p=page: self._on_navigated(p, frame))
+        async with self._cond:
+            self._creating -= 1
+            if isinstance(target, set):
+                target.add(page)
+            else:
+                target.append(page)
+            self._cond.notify()
+        return page
+
+    def _on_navigated(self, page: Page, frame):
+        meta = self._meta.get(page)
+        if meta is not None and frame.parent_frame is None:
+            meta["navigations"] += 1
+
+    async def release(self, page: Page):
+        async with self._cond:
+            self._in_use.discard(page)
+            if not page.is_closed() and self._total() < self.size:
+                # 先占住名额，采样判定后再决定放回空闲列表还是回收，不拖慢本次请求的返回
+                self._checking.add(page)
+                self._spawn(self._check(page))
+            self._cond.notify()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def session(self, page: Page):
+        """该页面专用的 CDP 会话，首次使用时创建，随页面关闭失效"""
+        meta = self._meta[page]
+        if meta["session"] is None:
+            meta["session"] = await self.context.new_cdp_session(page)
+            await meta["session"].send("Performance.enable")
+        return meta["session"]
+
+    async def _sample(self, page: Page):
+        """通过 CDP Performance 域读取页面的 JS 堆与 DOM 节点数"""
+        meta = self._meta[page]
+        result = await (await self.session(page)).send("Performance.getMetrics")
+        values = {m["name"]: m["value"] for m in result.get("metrics", [])}
+        meta["heap_mb"] = round(values.get("JSHeapUsedSize", 0) / 1024 / 1024, 1)
+        meta["dom_nodes"] = int(values.get("Nodes", 0))
+        self.stats["samples"] += 1
+        self.stats["heap_mb_max"] = max(self.stats["heap_mb_max"], meta["heap_mb"])
+        self.stats["dom_nodes_max"] = max(self.stats["dom_nodes_max"], meta["dom_nodes"])
+
+    def _retire_reason(self, page: Page) -> Optional[str]:
+        meta, policy = self._meta.get(page), self.policy
+        if meta is None:
+            return None
+        if policy.max_navigations and meta["navigations"] >= policy.max_navigations:
+            return "navigations"
+        if policy.max_heap_mb and meta["heap_mb"] >= policy.max_heap_mb:
+            return "heap"
+        if policy.max_dom_nodes and meta["dom_nodes"] >= policy.max_dom_nodes:
+            return "dom_nodes"
+        return None
+
+    async def _check(self, page: Page):
+        """归还后的回收判定：超过阈值则关闭页面并补建一个空闲页面，否则放回空闲列表"""
+        try:
+            await self._sample(page)
+        except Exception as e:
+            if not page.is_closed():
+                print(f"采样页面指标失败: {str(e)}")
+        reason = self._retire_reason(page)
+        if reason:
+            meta = self._meta[page]
+            self.stats["recycled"][reason] += 1
+            print(f"页面达到回收阈值（{reason}: 导航 {meta['navigations']} 次，JS 堆 {meta['heap_mb']}MB，"
+                  f"DOM 节点 {meta['dom_nodes']}），关闭并补建")
+            try:
+                await page.close()
+            except Exception:
+                pass
+        async with self._cond:
+            self._checking.discard(page)
+            replace = bool(reason) and self._total() < self.size
+            if replace:
+                self._creating += 1
+            elif not page.is_closed():
+                self._idle.append(page)
+            self._cond.notify()
+        if replace:
+            try:
+                await self._create_page(self._idle)
+            except Exception as e:
+                print(f"补建页面失败: {str(e)}")
+
+    def _forget(self, page: Page):
+        """页面关闭回调：从池中移除，归还时不会再被复用"""
+        self._meta.pop(page, None)
+        if page in self._idle:
+            self._idle.remove(page)
+
+    async def _reset(self, page: Page):
+        """
+        被中断的租借：浏览器侧的导航、等待与页面脚本不会随调用取消而停止，
+        先解除资源拦截、停止加载并回到空白页，再按正常流程归还；重置失败则关闭页面，由页面池补建
+        """
+        try:
+            session = await self.session(page)
+            await session.send("Network.setBlockedURLs", {"urls": []})
+            await session.send("Page.stopLoading")
+            await page.goto("about:blank", wait_until="commit", timeout=5000)
+        except Exception as e:
+            if not page.is_closed():
+                print(f"重置页面失败，关闭该页面: {str(e)}")
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+        await self.release(page)
+
+    @asynccontextmanager
+    async def lease(self, timeout: Optional[float] = None):
+        page = await self.acquire(timeout)
+        interrupted = False
+        try:
+            yield page
+        except asyncio.CancelledError:
+            interrupted = True
+            raise
+        finally:
+            if interrupted:
+                # 取消可能反复投递，重置放到后台任务中完成，页面在重置完成前不会被再次租出
+                self.stats["interrupted"] += 1
+                self._spawn(self._reset(page))
+            else:
+                await self.release(page)
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        pages = self._idle + list(self._in_use) + list(self._checking)
+        self._idle.clear()
+        self._in_use.clear()
+        self._checking.clear()
+        for page in pages:
+            try:
+                await page.close()
+            except Exception:
+                continue
+
+    def status(self) -> Dict[str, Any]:
+        leases = self.stats["leases"]
+        now = time.monotonic()
+        return {
+            "size": self.size,
+            "in_use": len(self._in_use),
+            "idle": len(self._idle),
+            "waiting": self._waiting,
+            # 采样中的页面同样占用名额，此时 acquire 也会阻塞
+            "exhausted": self._total() - len(self._idle) >= self.size,
+            "leases": leases,
+            "waits": self.stats["waits"],
+            "timeouts": self.stats["timeouts"],
+            "wait_ms_avg": round(self.stats["wait_ms_total"] / leases, 1) if leases else 0.0,
+            "wait_ms_max": round(self.stats["wait_ms_max"], 1),
+            "policy": asdict(self.policy),
+            "samples": self.stats["samples"],
+            "heap_mb_max": self.stats["heap_mb_max"],
+            "dom_nodes_max": self.stats["dom_nodes_max"],
+            "recycled": dict(self.stats["recycled"]),
+            "interrupted": self.stats["interrupted"],
+            "pages": [
+                {
+                    "navigations": meta["navigations"],
+                    "leases": meta["leases"],
+                    "heap_mb": meta["heap_mb"],
+                    "dom_nodes": meta["dom_nodes"],
+                    "age_s": round(now - meta["created"]),
+                }
+                for meta in self._meta.values()
+            ],
+        }
+
+
+# 资源拦截策略：策略名 -> 需要拦截的资源类型，只读工具只需要文本
+RESOURCE_POLICIES = {
+    "full": frozenset(),
+    "text": frozenset({"image", "media", "font", "tracker"}),
+}
+# 统计/埋点类请求，按 URL 归为 tracker
+TRACKER_PATTERN = re.compile(
+    r"apm-fe\.xiaohongshu\.com|t2\.xiaohongshu\.com|/api/v\d+/(?:collect|track)|sentry|google-analytics|hm\.baidu\.com"
+)
+# CDP Network.setBlockedURLs 的通配模式：按图片/视频 CDN 域名与字体扩展名拦截，
+# 站点的 JS/CSS（fe-static.xhscdn.com 等）不受影响
+BLOCK_URL_PATTERNS = {
+    "image": ["*://sns-webpic*.xhscdn.com/*", "*://sns-img*.xhscdn.com/*", "*://sns-avatar*.xhscdn.com/*",
+              "*://ci.xiaohongshu.com/*", "*://picasso-static.xiaohongshu.com/*"],
+    "media": ["*://sns-video*.xhscdn.com/*", "*.mp4*", "*.m3u8*"],
+    "font": ["*.woff2*", "*.woff*", "*.ttf*", "*.otf*"],
+    "tracker": ["*://apm-fe.xiaohongshu.com/*", "*://t2.xiaohongshu.com/*", "*/api/v*/collect*", "*/api/v*/track*",
+                "*sentry*", "*google-analytics.com/*", "*://hm.baidu.com/*"],
+}
+# 估算节省流量用的各类资源典型大小（字节）
+RESOURCE_SIZE_ESTIMATES = {"image": 80_000, "media": 500_000, "font": 40_000, "tracker": 1_000}
+
+
+class ResourceBlocker:
+    """
+    按策略通过 CDP Network.setBlockedURLs 拦截图片、视频、字体与埋点请求。
+    不用页面路由：路由生效期间该标签页的 HTTP 缓存被关闭，每次导航都要重新下载站点的 JS/CSS
+    每次调用统计拦截的请求数，以及实际传输的字节数与命中缓存的请求数，用于确认净节省
+    """
+
+    # 工具 -> 累计拦截统计
+    totals: Dict[str, Dict[str, Any]] = {}
+
+    def __init__(self, page: Page, policy: str = "full", tool: Optional[str] = None,
+                 pool: Optional[PagePool] = None):
+        self.page = page
+        self.pool = pool
+        self.blocked_types = RESOURCE_POLICIES[policy]
+        self.patterns = [pattern for kind in sorted(self.blocked_types) for pattern in BLOCK_URL_PATTERNS[kind]]
+        self.tool = tool or "unknown"
+        self.session = None
+        self.blocked: Dict[str, int] = {}
+        self.transferred_bytes = 0
+        self.cached_responses = 0
+
+    def _on_request_failed(self, request):
+        if "ERR_BLOCKED_BY_CLIENT" not in (request.failure or ""):
+            return
+        kind = "tracker" if TRACKER_PATTERN.search(request.url) else request.resource_type
+        self.blocked[kind] = self.blocked.get(kind, 0) + 1
+
+    def _on_loading_finished(self, event: Dict[str, Any]):
+        # encodedDataLength 是实际经网络传输的字节数，命中缓存时接近 0
+        self.transferred_bytes += int(event.get("encodedDataLength") or 0)
+
+    def _on_served_from_cache(self, event: Dict[str, Any]):
+        self.cached_responses += 1
+
+    async def __aenter__(self):
+        if self.blocked_types and self.pool:
+            self.session = await self.pool.session(self.page)
+            self.session.on("Network.loadingFinished", self._on_loading_finished)
+            self.session.on("Network.requestServedFromCache", self._on_served_from_cache)
+            self.page.on("requestfailed", self._on_request_failed)
+            await self.session.send("Network.enable")
+            await self.session.send("Network.setBlockedURLs", {"urls": self.patterns})
+        return self
+
+    async def __aexit__(self, *exc):
+        if not self.session:
+            return
+        self.page.remove_listener("requestfailed", self._on_request_failed)
+        self.session.remove_listener("Network.loadingFinished", self._on_loading_finished)
+        self.session.remove_listener("Network.requestServedFromCache", self._on_served_from_cache)
+        try:
+            await self.session.send("Network.setBlockedURLs", {"urls": []})
+            await self.session.send("Network.disable")
+        except Exception:
+            pass
+        summary = self.summary()
+        total = self.totals.setdefault(self.tool, {"calls": 0, "blocked_requests": 0, "bytes_saved_estimate": 0,
+                                                   "transferred_bytes": 0, "cached_responses": 0})
+        total["calls"] += 1
+        for key in ("blocked_requests", "bytes_saved_estimate", "transferred_bytes", "cached_responses"):
+            total[key] += summary[key]
+        total["last"] = summary
+        print(f"[{self.tool}] 拦截 {summary['blocked_requests']} 个请求"
+              f"（约 {summary['bytes_saved_estimate'] / 1024:.0f}KB），"
+              f"实际传输 {summary['transferred_bytes'] / 1024:.0f}KB，缓存命中 {summary['cached_responses']} 个")
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "blocked_requests": sum(self.blocked.values()),
+            "by_type": dict(self.blocked),
+            "bytes_saved_estimate": sum(RESOURCE_SIZE_ESTIMATES.get(kind, 0) * count
+                                        for kind, count in self.blocked.items()),
+            "transferred_bytes": self.transferred_bytes,
+            "cached_responses": self.cached_responses,
+        }
+
+
+class Histogram:
+    """固定桶的延迟直方图（毫秒），可估算分位数"""
+
+    BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, value_ms: float):
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if value_ms <= bound:
+                break
+        else:
+            i = len(self.BUCKETS_MS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """取落入桶的上界作为分位数估计，不超过观测到的最大值"""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                bound = self.BUCKETS_MS[i] if i < len(self.BUCKETS_MS) else self.max_ms
+                return round(min(bound, self.max_ms), 1)
+        return round(self.max_ms, 1)
+
+
+class Metrics:
+    """
+    工具调用的分阶段计时：每次调用内的 span（选浏览器、登录校验、导航、等待、提取、上传）
+    在调用结束后按 (工具, 浏览器, 阶段) 计入直方图，失败的阶段计入错误计数
+    """
+
+    def __init__(self):
+        self.histograms: Dict[tuple[str, str, str], Histogram] = {}
+        self.errors: Dict[tuple[str, str, str], int] = {}
+        self._call: ContextVar[Optional[Dict[str, Any]]] = ContextVar("metrics_call", default=None)
+
+    def timed(self, fn):
+        """工具装饰器：整个调用计为 total 阶段，返回 success=False 或抛出异常都计为错误"""
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            call = {"tool": fn.__name__, "browser": "-", "spans": [], "started": start}
+            token = self._call.set(call)
+            ok = False
+            try:
+                result = await fn(*args, **kwargs)
+                ok = not (isinstance(result, dict) and result.get("success") is False)
+                return result
+            finally:
+                self._call.reset(token)
+                call["spans"].append(("total", (time.perf_counter() - start) * 1000, ok))
+                self._flush(call)
+        return wrapper
+
+    @contextmanager
+    def span(self, phase: str):
+        """记录当前工具调用中某个阶段的耗时；不在工具调用内时不做任何事"""
+        call = self._call.get()
+        if call is None:
+            yield
+            return
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            call["spans"].append((phase, (time.perf_counter() - start) * 1000, ok))
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        """当前工具调用的计时记录（tool、browser、started、spans），不在工具调用内时为 None"""
+        return self._call.get()
+
+    def label_browser(self, browser_id: str):
+        call = self._call.get()
+        if call is not None:
+            call["browser"] = browser_id
+
+    def _flush(self, call: Dict[str, Any]):
+        for phase, elapsed_ms, ok in call["spans"]:
+            key = (call["tool"], call["browser"], phase)
+            self.histograms.setdefault(key, Histogram()).observe(elapsed_ms)
+            if not ok:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        tools: Dict[str, Any] = {}
+        for (tool, browser, phase), hist in sorted(self.histograms.items()):
+            tools.setdefault(tool, {}).setdefault(browser, {})[phase] = {
+                "count": hist.count,
+                "errors": self.errors.get((tool, browser, phase), 0),
+                "avg_ms": round(hist.sum_ms / hist.count, 1),
+                "p50_ms": hist.quantile(0.5),
+                "p95_ms": hist.quantile(0.95),
+                "max_ms": round(hist.max_ms, 1),
+            }
+        return tools
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = [
+            "# HELP xhs_tool_phase_seconds 工具调用各阶段耗时",
+            "# TYPE xhs_tool_phase_seconds histogram",
+        ]
+        for (tool, browser, phase), hist in sorted(self.histograms.items()):
+            labels = f'tool="{tool}",browser="{browser}",phase="{phase}"'
+            cumulative = 0
+            for bound, n in zip(hist.BUCKETS_MS, hist.counts):
+                cumulative += n
+                lines.append(f'xhs_tool_phase_seconds_bucket{{{labels},le="{bound / 1000:g}"}} {cumulative}')
+            lines.append(f'xhs_tool_phase_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+            lines.append(f"xhs_tool_phase_seconds_sum{{{labels}}} {hist.sum_ms / 1000:.6f}")
+            lines.append(f"xhs_tool_phase_seconds_count{{{labels}}} {hist.count}")
+        lines += [
+            "# HELP xhs_tool_phase_errors_total 工具调用各阶段失败次数",
+            "# TYPE xhs_tool_phase_errors_total counter",
+        ]
+        for (tool, browser, phase), n in sorted(self.errors.items()):
+            lines.append(f'xhs_tool_phase_errors_total{{tool="{tool}",browser="{browser}",phase="{phase}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+_call_deadline: ContextVar[Optional[float]] = ContextVar("call_deadline", default=None)
+
+
+@asynccontextmanager
+async def call_deadline(seconds: Optional[float]):
+    """
+    工具调用的截止时间：到期时取消调用内正在进行的浏览器操作并抛出 TimeoutError，
+    被中断的标签页由页面池在后台重置后归还；seconds 不填或为 0 时不限时，嵌套时以更早的截止时间为准
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = _call_deadline.get()
+    token = _call_deadline.set(min(deadline, outer) if outer else deadline)
+    # asyncio.timeout 需要 Python 3.11，这里用定时取消当前任务实现，兼容 3.10
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    expired = False
+
+    def expire():
+        nonlocal expired
+        expired = True
+        task.cancel()
+
+    handle = loop.call_at(loop.time() + seconds, expire)
+    try:
+        yield
+    except asyncio.CancelledError:
+        if not expired:
+            raise
+        # 由截止时间引发的取消转换为 TimeoutError，外部（如 MCP 客户端）的取消照常向上传播
+        if hasattr(task, "uncancel"):
+            task.uncancel()
+        raise TimeoutError(f"调用超过截止时间（{seconds}s）") from None
+    finally:
+        handle.cancel()
+        _call_deadline.reset(token)
+
+
+def remaining_ms(default: float, reserve_ms: float = 0) -> float:
+    """
+    截止时间内还可用于一次浏览器操作的毫秒数，不超过 default；不在限时调用内时返回 default
+    浏览器侧的等待不会随调用取消而停止，传给 Playwright 的超时按此裁剪
+    """
+    deadline = _call_deadline.get()
+    if deadline is None:
+        return default
+    return max(1.0, min(default, (deadline - time.monotonic()) * 1000 - reserve_ms))
+
+
+class TraceRecorder:
+    """
+    按需开启的 Playwright 追踪：工具调用租借页面期间在所属上下文上录制一段 trace，
+    只保留超过耗时阈值或出错的调用，连同分阶段耗时写入按总大小淘汰的磁盘环形缓冲
+    Playwright 按上下文录制，同一上下文同一时刻只能录制一个调用；其余并发调用不单独录制，
+    但它们在其他标签页上的操作仍会落入正在录制的 trace，这些调用记录在元数据的 concurrent 字段中
+    """
+
+    def __init__(self, directory: Path, enabled: bool = False, slow_ms: float = 10000,
+                 max_bytes: int = 200 * 1024 * 1024, screenshots: bool = False):
+        self.directory = directory
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.max_bytes = max_bytes
+        self.screenshots = screenshots
+        # 上下文 -> 是否正在录制；上下文重建后旧条目自动释放
+        self._contexts: "weakref.WeakKeyDictionary[BrowserContext, bool]" = weakref.WeakKeyDictionary()
+        # 上下文 -> 在途调用（标识 -> 工具名），以及正在录制的 trace 期间出现过的其他调用
+        self._inflight: "weakref.WeakKeyDictionary[BrowserContext, Dict[object, str]]" = weakref.WeakKeyDictionary()
+        self._overlap: "weakref.WeakKeyDictionary[BrowserContext, list[str]]" = weakref.WeakKeyDictionary()
+        self.stats = {"recorded": 0, "kept": 0, "discarded": 0, "skipped_busy": 0, "errors": 0}
+
+    @asynccontextmanager
+    async def record(self, context: BrowserContext, browser_id: str):
+        call = metrics.current()
+        tool = (call["tool"] if call else None) or "unknown"
+        inflight = self._inflight.setdefault(context, {})
+        token = object()
+        inflight[token] = tool
+        try:
+            recording = False
+            if self.enabled:
+                if self._contexts.get(context):
+                    self.stats["skipped_busy"] += 1
+                    self._overlap.setdefault(context, []).append(tool)
+                else:
+                    recording = await self._start(context)
+                    if recording:
+                        self._overlap[context] = [name for key, name in inflight.items() if key is not token]
+            if not recording:
+                yield
+                return
+
+            start = time.perf_counter()
+            error = None
+            try:
+                yield
+            except BaseException as e:
+                error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                await self._finish(context, browser_id, start, error)
+        finally:
+            inflight.pop(token, None)
+
+    async def _start(self, context: BrowserContext) -> bool:
+        try:
+            if context not in self._contexts:
+                await context.tracing.start(snapshots=True, screenshots=self.screenshots)
+            self._contexts[context] = True
+            await context.tracing.start_chunk()
+            return True
+        except Exception as e:
+            self._contexts[context] = False
+            self.stats["errors"] += 1
+            print(f"开始录制 trace 失败: {e}")
+            return False
+
+    async def _finish(self, context: BrowserContext, browser_id: str, start: float, error: Optional[str]):
+        call = metrics.current()
+        # 耗时从工具调用开始计算，包含选浏览器、限流等租借页面之前的阶段
+        elapsed_ms = (time.perf_counter() - (call["started"] if call else start)) * 1000
+        keep = error is not None or elapsed_ms >= self.slow_ms
+        trace_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        path = self.directory / f"{trace_id}.zip"
+        self.stats["recorded"] += 1
+        try:
+            if keep:
+                self.directory.mkdir(parents=True, exist_ok=True)
+            await context.tracing.stop_chunk(path=str(path) if keep else None)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"保存 trace 失败: {e}")
+            return
+        finally:
+            self._contexts[context] = False
+            concurrent = self._overlap.pop(context, [])
+        if not keep:
+            self.stats["discarded"] += 1
+            return
+        meta = {
+            "id": trace_id,
+            "tool": call["tool"] if call else None,
+            "browser": browser_id,
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "duration_ms": round(elapsed_ms, 1),
+            "error": error,
+            "reason": "error" if error else "slow",
+            # 录制期间同一上下文上并发执行的其他调用，其操作可能混入本 trace
+            "concurrent": sorted(set(concurrent)),
+            "spans": [{"phase": phase, "ms": round(ms, 1), "ok": ok} for phase, ms, ok in (call or {}).get("spans", [])],
+            "size": path.stat().st_size if path.exists() else 0,
+        }
+        (self.directory / f"{trace_id}.json").write_text(json.dumps(meta, ensure_ascii=False))
+        self.stats["kept"] += 1
+        print(f"已保存 {meta['tool']} 的 trace（{meta['reason']}，{meta['duration_ms']}ms）: {trace_id}")
+        self._prune()
+
+    def _prune(self):
+        """按保存时间淘汰最旧的 trace，直到总大小不超过上限"""
+        entries = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        sizes = {meta: meta.stat().st_size + (meta.with_suffix(".zip").stat().st_size
+                                              if meta.with_suffix(".zip").exists() else 0) for meta in entries}
+        total = sum(sizes.values())
+        for meta in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= sizes[meta]
+            meta.with_suffix(".zip").unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+
+    def list(self) -> list[Dict[str, Any]]:
+        traces = []
+        for meta in self.directory.glob("*.json"):
+            try:
+                traces.append(json.loads(meta.read_text()))
+            except Exception:
+                continue
+        return sorted(traces, key=lambda t: t["id"], reverse=True)
+
+    def path_of(self, trace_id: str) -> Optional[Path]:
+        if not re.fullmatch(r"[\w-]+", trace_id or ""):
+            return None
+        path = self.directory / f"{trace_id}.zip"
+        return path if path.is_file() else None
+
+    def status(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "slow_ms": self.slow_ms, "max_bytes": self.max_bytes, **self.stats}
+
+
+tracer = TraceRecorder(Path(__file__).resolve().parent / "traces")
+
+
+class ElementState:
+    """等待元素进入指定状态：attached / detached / visible / hidden"""
+
+    def __init__(self, selector: str, state: str = "visible"):
+        self.selector = selector
+        self.state = state
+
+    async def wait(self, page: Page, timeout_ms: float):
+        await page.wait_for_selector(self.selector, state=self.state, timeout=timeout_ms)
+
+    def __repr__(self):
+        return f"{self.selector}:{self.state}"
+
+
+# 节点数量连续 quiet 毫秒不变且不少于 min 时视为稳定；状态按 token 隔离，避免复用上一次等待的记录
+COUNT_SETTLED_JS = """
+([selector, min, quiet, token]) => {
+    const store = window.__xhsSettle || (window.__xhsSettle = {});
+    const count = document.querySelectorAll(selector).length;
+    const now = performance.now();
+    const last = store[token];
+    if (!last || last.count !== count) {
+        store[token] = {count, at: now};
+        return false;
+    }
+    if (count >= min && now - last.at >= quiet) {
+        delete store[token];
+        return true;
+    }
+    return false;
+}
+"""
+
+
+class CountSettled:
+    """等待匹配节点的数量稳定（如滚动加载后卡片渲染完成）"""
+
+    def __init__(self, selector: str, min_count: int = 1, quiet_ms: int = 300):
+        self.selector = selector
+        self.min_count = min_count
+        self.quiet_ms = quiet_ms
+
+    async def wait(self, page: Page, timeout_ms: float):
+        args = [self.selector, self.min_count, self.quiet_ms, uuid.uuid4().hex]
+        await page.wait_for_function(COUNT_SETTLED_JS, arg=args, polling=100, timeout=timeout_ms)
+
+    def __repr__(self):
+        return f"{self.selector}:count>={self.min_count}"
+
+
+class RouteIdle:
+    """
+    等待匹配接口的请求全部结束并静默 quiet_ms，需要在触发请求的动作之前创建
+    动作之后没有发出请求时，静默期过后即视为就绪
+    """
+
+    def __init__(self, page: Page, pattern: str, quiet_ms: int = 300):
+        self.page = page
+        self.pattern = re.compile(pattern)
+        self.quiet_ms = quiet_ms
+        self.in_flight: set = set()
+        self.last_activity = time.monotonic()
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_done)
+        page.on("requestfailed", self._on_done)
+
+    def _on_request(self, request):
+        if self.pattern.search(request.url):
+            self.in_flight.add(request)
+            self.last_activity = time.monotonic()
+
+    def _on_done(self, request):
+        if request in self.in_flight:
+            self.in_flight.discard(request)
+            self.last_activity = time.monotonic()
+
+    async def wait(self, page: Page, timeout_ms: float):
+        deadline = time.monotonic() + timeout_ms / 1000
+        try:
+            while self.in_flight or time.monotonic() - self.last_activity < self.quiet_ms / 1000:
+                if time.monotonic() >= deadline:
+                    raise PlaywrightTimeoutError(f"等待接口 {self.pattern.pattern} 空闲超时")
+                await asyncio.sleep(0.05)
+        finally:
+            self.close()
+
+    def close(self):
+        for event, handler in (("request", self._on_request), ("requestfinished", self._on_done),
+                               ("requestfailed", self._on_done)):
+            try:
+                self.page.remove_listener(event, handler)
+            except Exception:
+                pass
+
+    def __repr__(self):
+        return f"{self.pattern.pattern}:idle"
+
+
+class Readiness:
+    """
+    事件驱动的就绪等待：各工具声明等待的条件（元素出现/消失、节点数稳定、接口空闲），
+    按工具设置超时，并记录每处等待的实际耗时与原固定等待时长的差值
+    """
+
+    # 工具 -> 单处等待的超时（毫秒）
+    TIMEOUTS_MS = {
+        "search_articles": 8000,
+        "get_article_content": 8000,
+        "view_article_comments": 10000,
+        "get_new_comments": 10000,
+        "post_comment": 10000,
+        "post_note": 30000,
+    }
+    DEFAULT_TIMEOUT_MS = 10000
+
+    def __init__(self):
+        self.stats: Dict[str, Dict[str, Any]] = {}
+
+    async def wait(self, page: Page, name: str, *conditions, replaces_ms: Optional[float] = None,
+                   timeout_ms: Optional[float] = None, required: bool = False) -> bool:
+        """
+        依次等待所有条件满足，共用一个超时；超时返回 False，required 时抛出异常
+        args:
+            name: 等待点名称，用于统计
+            replaces_ms: 该处原来的固定等待时长，用于统计节省的时间
+        """
+        call = metrics.current()
+        if timeout_ms is None:
+            timeout_ms = self.TIMEOUTS_MS.get(call["tool"] if call else "", self.DEFAULT_TIMEOUT_MS)
+        timeout_ms = remaining_ms(timeout_ms)
+        start = time.perf_counter()
+        ok = True
+        with metrics.span("wait"):
+            try:
+                for condition in conditions:
+                    remaining = timeout_ms - (time.perf_counter() - start) * 1000
+                    await condition.wait(page, max(remaining, 1))
+            except PlaywrightTimeoutError:
+                ok = False
+            finally:
+                for condition in conditions:
+                    if hasattr(condition, "close"):
+                        condition.close()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._record(name, elapsed_ms, ok, replaces_ms)
+        if not ok:
+            message = f"等待 {name} 超时（{timeout_ms:.0f}ms）: {', '.join(map(repr, conditions))}"
+            if required:
+                raise RuntimeError(message)
+            print(message)
+        return ok
+
+    def _record(self, name: str, elapsed_ms: float, ok: bool, replaces_ms: Optional[float]):
+        stat = self.stats.setdefault(name, {"count": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                            "replaces_ms": replaces_ms, "saved_ms_total": 0.0})
+        stat["count"] += 1
+        stat["timeouts"] += 0 if ok else 1
+        stat["total_ms"] += elapsed_ms
+        stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+        if replaces_ms is not None:
+            stat["saved_ms_total"] += replaces_ms - elapsed_ms
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "count": stat["count"],
+                "timeouts": stat["timeouts"],
+                "avg_ms": round(stat["total_ms"] / stat["count"], 1),
+                "max_ms": round(stat["max_ms"], 1),
+                "replaces_ms": stat["replaces_ms"],
+                "avg_saved_ms": round(stat["saved_ms_total"] / stat["count"], 1)
+                if stat["replaces_ms"] is not None else None,
+            }
+            for name, stat in self.stats.items()
+        }
+
+
+readiness = Readiness()
+
+
+class CdpProber:
+    """
+    CDP 端点健康探测：复用一个 HTTP 连接池，后台定时并发探测所有浏览器端点，
+    缓存 WebSocket URL、可用状态与延迟，请求时选择浏览器不再等待失联主机超时
+    """
+
+    def __init__(self, interval: float = 10, timeout: float = 2):
+        self.interval = interval
+        self.timeout = timeout
+        self.endpoints: Dict[str, Dict[str, Any]] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _session_get(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Accept": "application/json"},
+            )
+        return self._session
+
+    def _fresh(self, cdp_url: str) -> Optional[Dict[str, Any]]:
+        """返回仍在有效期内（两个探测周期）的探测结果"""
+        endpoint = self.endpoints.get(cdp_url)
+        if endpoint and time.monotonic() - endpoint["checked_at"] < self.interval * 2:
+            return endpoint
+        return None
+
+    async def probe(self, cdp_url: str) -> Dict[str, Any]:
+        start = time.perf_counter()
+        ws_url, error = None, None
+        try:
+            if cdp_url.startswith(("ws://", "wss://")):
+                # 直接检查 WebSocket 连接
+                async with self._session_get().ws_connect(cdp_url):
+                    ws_url = cdp_url
+            else:
+                async with self._session_get().get(f"{cdp_url}/json/version") as resp:
+                    resp.raise_for_status()
+                    data = await resp.json(content_type=None)
+                    ws_url = data["webSocketDebuggerUrl"]
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        previous = self.endpoints.get(cdp_url)
+        endpoint = {
+            "up": ws_url is not None,
+            "ws_url": ws_url,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            "checked_at": time.monotonic(),
+            "error": error,
+        }
+        if previous is None or previous["up"] != endpoint["up"]:
+            print(f"CDP 端点 {cdp_url} {'可用' if endpoint['up'] else '不可用'}" + (f": {error}" if error else ""))
+        self.endpoints[cdp_url] = endpoint
+        return endpoint
+
+    async def probe_all(self, cdp_urls: list[str]) -> list[Dict[str, Any]]:
+        return await asyncio.gather(*(self.probe(url) for url in cdp_urls))
+
+    def is_down(self, cdp_url: str) -> bool:
+        endpoint = self._fresh(cdp_url)
+        return bool(endpoint and not endpoint["up"])
+
+    async def ws_url(self, cdp_url: str) -> str:
+        """返回端点的 WebSocket URL；缓存过期时当场探测一次，不可用时抛出异常"""
+        endpoint = self._fresh(cdp_url) or await self.probe(cdp_url)
+        if not endpoint["up"]:
+            raise Exception(f"CDP URL 不可用: {cdp_url}")
+        return endpoint["ws_url"]
+
+    def start(self, browsers: Dict[str, "XiaohongshuBrowser"]):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(browsers))
+
+    async def _run(self, browsers: Dict[str, "XiaohongshuBrowser"]):
+        while True:
+            try:
+                await self.probe_all([b.cdp_url for b in browsers.values()])
+                # 端点恢复可用但连接已断开的浏览器在后台重连，不占用请求时间
+                for browser_id, browser in browsers.items():
+                    if not self.is_down(browser.cdp_url) and not browser._is_ready():
+                        asyncio.create_task(self._reconnect(browser_id, browser))
+            except Exception as e:
+                print(f"CDP 探测出错: {e}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    async def _reconnect(browser_id: str, browser: "XiaohongshuBrowser"):
+        try:
+            await browser._ensure_browser()
+            print(f"{browser_id} 浏览器已在后台重连")
+        except Exception as e:
+            print(f"{browser_id} 浏览器后台重连失败: {e}")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def status(self, cdp_url: str) -> Optional[Dict[str, Any]]:
+        endpoint = self.endpoints.get(cdp_url)
+        if endpoint is None:
+            return None
+        return {
+            "up": endpoint["up"],
+            "latency_ms": endpoint["latency_ms"],
+            "checked_ago_s": round(time.monotonic() - endpoint["checked_at"], 1),
+            "error": endpoint["error"],
+        }
+
 
 class XiaohongshuBrowser:
-    def __init__(self, cdp_url: str = "http://127.0.0.1:9222"):
+    def __init__(self, cdp_url: str = "http://127.0.0.1:9222", pool_size: int = 3, login_ttl: float = 300,
+                 capture_api: bool = False, recycle: Optional[RecyclePolicy] = None):
         self.playwright: Optional[Playwright] = None
         self.browser: Optional[Browser] = None
         self.context: Optional[BrowserContext] = None
-        self.page: Optional[Page] = None
+        self.pool: Optional[PagePool] = None
+        self.pool_size = pool_size
+        self.recycle = recycle or RecyclePolicy()  # 按设备配置的标签页回收阈值，重建上下文后沿用
+        self.capture_api = capture_api  # 是否启用接口响应捕获
+        self.capture: Optional[ResponseCapture] = None
         self.is_logged_in = False
+        self.login_ttl = login_ttl
+        self.login_checked_at = 0.0  # 上次校验登录状态的时间（monotonic），0 表示缓存无效
+        self._login_task: Optional[asyncio.Task] = None
         self.cdp_url = cdp_url
         self.auth_file = Path(__file__).resolve().parent / "xiaohongshu_auth.json"
+        self._context_closed = False
+        self._recovery: Optional[asyncio.Task] = None  # 进行中的恢复任务，并发调用共享同一次恢复
+        self._backoff = 0.0  # 完整重连失败后的退避秒数，成功后清零
+        self._retry_at = 0.0
 
     async def _setup_browser(self):
+        await self._connect()
+        await self._new_context()
+
+    async def _connect(self):
+        """建立到远程浏览器的 CDP 连接"""
+        # 优先使用后台探测缓存的 WebSocket URL，已知不可用时立即失败
+        ws_url = await cdp_prober.ws_url(self.cdp_url)
+        self.playwright = await shared_playwright()
+        self.browser = await self.playwright.chromium.connect_over_cdp(ws_url, timeout=5000)
+
+    async def _new_context(self):
+        """在已连接的浏览器上新建上下文、页面池与接口捕获"""
         if not os.path.exists(self.auth_file):
             with open(self.auth_file, "w") as f:
                 f.write("{}")
-        # 快速检查 CDP 是否可用
-        if not await self.is_cdp_available(self.cdp_url):
-            raise Exception("CDP URL 不可用")
-        # 获取 WebSocket URL
-        ws_url = await self.get_ws_url(self.cdp_url)
-        stealth = Stealth(
-            navigator_user_agent_override="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
-            , navigator_languages_override=("zh-CN", 'zh')
-        )
-        self.playwright = await stealth.use_async(async_playwright()).__aenter__()
-        self.browser = await self.playwright.chromium.connect_over_cdp(ws_url, timeout=5000)
-
         self.context = await self.browser.new_context(
             storage_state=self.auth_file
             , ignore_https_errors=True
@@ -50,89 +1118,168 @@ class XiaohongshuBrowser:
             , bypass_csp=True
         )
         self.context.set_default_timeout(15000)
-        self.page = await self.context.new_page()
+        self.pool = PagePool(self.context, size=self.pool_size, policy=self.recycle)
+        self.capture = ResponseCapture(self.context) if self.capture_api else None
 
-        def close_callback():
-            print("页面关闭回调")
+        def close_callback(*_):
+            print("浏览器上下文关闭回调")
+            self._context_closed = True
             self.is_logged_in = False
-
-        self.page.on('close', close_callback)
-
-    async def is_cdp_available(self, cdp_url: str, timeout: int = 2) -> bool:
-        """快速检查 CDP URL 是否可用"""
+            self.login_checked_at = 0.0
+
+        self.context.on('close', close_callback)
+        self._context_closed = False
+        self.login_checked_at = 0.0
+        if self._login_task:
+            self._login_task.cancel()
+        self._login_task = asyncio.create_task(self._login_revalidate_loop())
+
+    async def fetch_html(self, url: str, timeout: float = 10000) -> tuple[int, str]:
+        """通过上下文的请求接口获取页面 HTML，携带该上下文的 cookies，不占用标签页"""
+        response = await self.context.request.get(url, timeout=remaining_ms(timeout), headers={
+            "Accept": "text/html,application/xhtml+xml",
+            "Referer": "https://www.xiaohongshu.com/",
+        })
         try:
-            if cdp_url.startswith("http"):
-                # 检查 HTTP CDP 端点
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                            f"{cdp_url}/json/version",
-                            timeout=timeout,
-                            headers={"Accept": "application/json"}
-                    ) as resp:
-                        return resp.status == 200
-
-            elif cdp_url.startswith(("ws://", "wss://")):
-                # 直接检查 WebSocket 连接
-                async with aiohttp.ClientSession() as session:
-                    async with session.ws_connect(cdp_url, timeout=timeout):
-                        return True
-
-            return False
-        except:
-            return False
+            return response.status, await response.text()
+        finally:
+            await response.dispose()
 
-    async def get_ws_url(self, cdp_url: str) -> str:
-        """获取可用的 WebSocket URL"""
-        if cdp_url.startswith(("ws://", "wss://")):
-            return cdp_url
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                        f"{cdp_url}/json/version",
-                        timeout=3,
-                        headers={"Accept": "application/json"}
-                ) as resp:
-                    data = await resp.json()
-                    return data["webSocketDebuggerUrl"]
-        except:
-            return cdp_url  # 失败时返回原 URL
+    def _is_ready(self) -> bool:
+        return bool(self.browser and self.browser.is_connected() and self.context and not self._context_closed
+                    and self.pool)
 
     async def _ensure_browser(self):
-        if not self.page or self.page.is_closed():
+        """
+        分级恢复：页面失效由页面池补建；上下文失效只重建上下文；
+        浏览器断开才完整重连，失败后指数退避，并发调用共享同一次恢复
+        """
+        if self._is_ready():
+            return
+        if self._recovery is None or self._recovery.done():
+            self._recovery = asyncio.create_task(self._recover())
+        # shield：单个调用方被取消不影响其他等待同一次恢复的调用方
+        await asyncio.shield(self._recovery)
+
+    async def _recover(self):
+        if self.browser and self.browser.is_connected():
+            print(f"{self.cdp_url} 浏览器上下文已失效，仅重建上下文")
+            await self._discard_context()
+            await self._new_context()
+            return
+
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise RuntimeError(f"{self.cdp_url} 重连退避中，{self._retry_at - now:.1f}s 后重试")
+        await self._discard_context()
+        await self._discard_browser()
+        try:
             await self._setup_browser()
+        except Exception:
+            self._backoff = min(self._backoff * 2 or 1.0, 60.0)
+            self._retry_at = time.monotonic() + self._backoff
+            raise
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+    async def _discard_context(self):
+        """释放失效的上下文及其页面，避免旧对象泄漏"""
+        if self._login_task:
+            self._login_task.cancel()
+            self._login_task = None
+        pool, context = self.pool, self.context
+        self.pool, self.context, self.capture = None, None, None
+        for closer in (pool.close if pool else None, context.close if context else None):
+            if closer:
+                try:
+                    await closer()
+                except Exception:
+                    pass
+
+    async def _discard_browser(self):
+        browser, self.browser = self.browser, None
+        if browser:
+            try:
+                await browser.close()
+            except Exception:
+                pass
 
     async def _save_session(self):
         try:
-            await self.page.context.storage_state(path=self.auth_file)
+            await self.context.storage_state(path=self.auth_file)
             print("登录状态已保存")
         except Exception as e:
             print(f"保存会话失败: {str(e)}")
 
     async def _check_login_status(self):
-        if self.is_logged_in:
+        """读取缓存的登录状态；缓存失效时通过 cookie 与用户接口校验，不做页面导航"""
+        if self.login_checked_at and time.monotonic() - self.login_checked_at < self.login_ttl:
+            return self.is_logged_in
+        if self.login_checked_at and self.is_logged_in:
+            # 缓存过期但上次为已登录：先返回旧值，由后台任务重新校验
+            asyncio.create_task(self._revalidate_login())
             return True
+        return await self._revalidate_login()
+
+    async def _revalidate_login(self) -> bool:
+        """
+        校验登录状态：没有会话 cookie 时直接判定未登录；
+        否则用上下文的请求接口（携带 cookies，不占用标签页）查询当前用户，游客会话也会下发 web_session，需以接口返回为准
+        """
         try:
-            await self.page.goto("https://www.xiaohongshu.com/", wait_until="domcontentloaded")
-            # 检查是否存在登录按钮
-            login_btns = await self.page.query_selector_all(".login-btn, .sign-in")
-            # 检查是否存在用户头像
-            avatar = await self.page.query_selector(".reds-avatar")
-            is_logged_in = avatar or len(login_btns) == 0
-            self.is_logged_in = is_logged_in
-            print("检测到已登录状态" if is_logged_in else "检测到未登录状态")
-            return is_logged_in
+            cookies = await self.context.cookies("https://www.xiaohongshu.com")
+            now = time.time()
+            has_session = any(
+                c["name"] == LOGIN_COOKIE and c["value"] and (c.get("expires", -1) < 0 or c["expires"] > now)
+                for c in cookies
+            )
+            is_logged_in = has_session and await self._fetch_login_user()
         except Exception as e:
+            # 接口暂时不可用时保留上次结论，下次调用重新校验
             print(f"检查登录状态失败: {str(e)}", e)
-            return False
+            return self.is_logged_in
+        if is_logged_in != self.is_logged_in or not self.login_checked_at:
+            print("检测到已登录状态" if is_logged_in else "检测到未登录状态")
+        self.is_logged_in = is_logged_in
+        self.login_checked_at = time.monotonic()
+        return is_logged_in
+
+    async def _fetch_login_user(self, url: str = LOGIN_USER_API) -> bool:
+        """请求当前用户接口，游客会话返回 guest=true"""
+        response = await self.context.request.get(url, timeout=remaining_ms(5000), headers={
+            "Accept": "application/json",
+            "Origin": "https://www.xiaohongshu.com",
+            "Referer": "https://www.xiaohongshu.com/",
+        })
+        try:
+            if response.status in (401, 403, 461):
+                return False
+            if not response.ok:
+                raise RuntimeError(f"用户接口返回 {response.status}")
+            data = await response.json()
+        finally:
+            await response.dispose()
+        user = data.get("data") or {}
+        return bool(data.get("success") and user.get("user_id") and not user.get("guest", True))
+
+    async def _login_revalidate_loop(self):
+        """后台定期校验登录状态，让工具调用始终命中缓存"""
+        while True:
+            await asyncio.sleep(self.login_ttl / 2)
+            if self.context:
+                await self._revalidate_login()
 
     async def _close_browser(self) -> Dict[str, Any]:
+        if self._login_task:
+            self._login_task.cancel()
+            self._login_task = None
         resources = [
-            ("page", lambda: self.page.close(), "页面"),
+            ("pool", lambda: self.pool.close(), "页面池"),
             ("context", lambda: self.context.close(), "浏览器上下文"),
             ("browser", lambda: self.browser.close(), "浏览器"),
-            ("playwright", lambda: self.playwright.stop(), "Playwright")
         ]
+        # Playwright 驱动为所有浏览器共用，由 clean_browsers 统一停止
+        self.playwright = None
 
         results = []
         for attr, closer, name in resources:
@@ -153,47 +1300,449 @@ class XiaohongshuBrowser:
             "details": results
         }
 
+class BrowserLoad:
+    """单个浏览器的负载统计：在途请求数、近期延迟与错误率（指数滑动平均）"""
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.in_flight = 0
+        self.latency_ms: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.down_until = 0.0  # 连接失败后的冷却截止时间
+
+    def record(self, latency_ms: float, ok: bool):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        if self.latency_ms is None:
+            self.latency_ms = latency_ms
+        else:
+            self.latency_ms += self.alpha * (latency_ms - self.latency_ms)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def is_down(self) -> bool:
+        return time.monotonic() < self.down_until
+
+    def score(self, default_latency_ms: float) -> float:
+        """分数越低越优先：排队成本 × 近期延迟 × 错误惩罚"""
+        latency = self.latency_ms if self.latency_ms is not None else default_latency_ms
+        return (self.in_flight + 1) * latency * (1 + 4 * self.error_rate)
+
+
+class BrowserScheduler:
+    """按负载在所有健康浏览器间分配请求，并支持写操作按账号粘滞"""
+
+    def __init__(self, browsers: Dict[str, XiaohongshuBrowser], down_cooldown: float = 30,
+                 affinity_ttl: float = 30 * 60):
+        self.browsers = browsers
+        self.loads = {browser_id: BrowserLoad() for browser_id in browsers}
+        self.down_cooldown = down_cooldown
+        self.affinity_ttl = affinity_ttl
+        self._affinity: Dict[str, tuple[str, float]] = {}
+
+    def name_of(self, browser: XiaohongshuBrowser) -> str:
+        for browser_id, b in self.browsers.items():
+            if b is browser:
+                return browser_id
+        return browser.cdp_url
+
+    def candidates(self, account: Optional[str] = None, affinity_key: Optional[str] = None) -> list[str]:
+        """返回按优先级排序的浏览器 id 列表"""
+        if account:
+            if account not in self.browsers:
+                raise RuntimeError(f"未知账号: {account}")
+            # 指定账号的写操作只能在该账号的浏览器上执行
+            return [account]
+
+        known = [load.latency_ms for load in self.loads.values() if load.latency_ms is not None]
+        default_latency = sorted(known)[len(known) // 2] if known else 1000.0
+        ranked = sorted(
+            self.browsers,
+            key=lambda bid: (self.is_down(bid), self.loads[bid].score(default_latency), random.random())
+        )
+        sticky = self._sticky(affinity_key)
+        if sticky and not self.is_down(sticky):
+            ranked.remove(sticky)
+            ranked.insert(0, sticky)
+        return ranked
+
+    def _sticky(self, affinity_key: Optional[str]) -> Optional[str]:
+        if not affinity_key or affinity_key not in self._affinity:
+            return None
+        browser_id, expires = self._affinity[affinity_key]
+        if time.monotonic() > expires:
+            del self._affinity[affinity_key]
+            return None
+        return browser_id
+
+    def bind(self, affinity_key: Optional[str], browser_id: str):
+        if affinity_key:
+            self._affinity[affinity_key] = (browser_id, time.monotonic() + self.affinity_ttl)
+
+    def is_down(self, browser_id: str) -> bool:
+        """连接失败冷却中，或最近一次 CDP 探测不可用"""
+        return self.loads[browser_id].is_down() or cdp_prober.is_down(self.browsers[browser_id].cdp_url)
+
+    def mark_down(self, browser_id: str):
+        self.loads[browser_id].down_until = time.monotonic() + self.down_cooldown
+
+    @asynccontextmanager
+    async def track(self, browser_id: str):
+        load = self.loads[browser_id]
+        load.in_flight += 1
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            load.in_flight -= 1
+            load.record((time.perf_counter() - start) * 1000, ok)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            browser_id: {
+                "in_flight": load.in_flight,
+                "latency_ms": round(load.latency_ms, 1) if load.latency_ms is not None else None,
+                "error_rate": round(load.error_rate, 3),
+                "requests": load.requests,
+                "errors": load.errors,
+                "down": self.is_down(browser_id),
+            }
+            for browser_id, load in self.loads.items()
+        }
+
+
+class TokenBucket:
+    """令牌桶：容量 capacity，每 refill_seconds 补充一个令牌；令牌可透支为负数，表示已排队的预约"""
+
+    def __init__(self, capacity: int, refill_seconds: float):
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) / self.refill_seconds)
+        self.updated_at = now
+
+    def reserve(self, max_wait: Optional[float] = None) -> float:
+        """预约一个令牌，返回需要等待的秒数；超过 max_wait 时不预约并返回 -1"""
+        self._refill()
+        wait = max(0.0, (1 - self.tokens) * self.refill_seconds)
+        if max_wait is not None and wait > max_wait:
+            return -1
+        self.tokens -= 1
+        return wait
+
+    def cancel(self):
+        self.tokens += 1
+
+    def status(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "capacity": self.capacity,
+            "refill_seconds": self.refill_seconds,
+            "estimated_wait": round(max(0.0, (1 - self.tokens) * self.refill_seconds), 1),
+        }
+
+
+class RateLimiter:
+    """按账号（浏览器）与操作类型分别限流，超出频率的调用排队等待而不是失败"""
+
+    def __init__(self, limits: Dict[str, tuple[int, float]]):
+        self.limits = limits
+        self._buckets: Dict[tuple[str, str], TokenBucket] = {}
+
+    def bucket(self, account: str, kind: str) -> TokenBucket:
+        if (account, kind) not in self._buckets:
+            self._buckets[(account, kind)] = TokenBucket(*self.limits[kind])
+        return self._buckets[(account, kind)]
+
+    async def acquire(self, account: str, kind: str, max_wait: Optional[float] = None):
+        bucket = self.bucket(account, kind)
+        wait = bucket.reserve(max_wait)
+        if wait < 0:
+            estimated = bucket.status()["estimated_wait"]
+            raise RuntimeError(f"账号 {account} 的 {kind} 操作频率受限，需等待约 {estimated}s，超过允许的 {max_wait}s")
+        if wait > 0:
+            print(f"账号 {account} 的 {kind} 操作排队 {wait:.1f}s")
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                bucket.cancel()
+                raise
+
+    def status(self, account: str) -> Dict[str, Any]:
+        return {kind: self.bucket(account, kind).status() for kind in self.limits}
+
+
+class NoteCache:
+    """
+    基于 SQLite 的笔记内容/评论缓存，按笔记 id 存储，重启后仍然有效
+    每类数据独立设置 TTL 与条目上限，超出上限时按最近访问时间淘汰（LRU）
+    """
+
+    def __init__(self, path: Union[str, Path], ttl: Optional[Dict[str, float]] = None,
+                 max_entries: Optional[Dict[str, int]] = None):
+        self.ttl = ttl or {"content": 24 * 3600, "comments": 30 * 60}
+        self.max_entries = max_entries or {"content": 5000, "comments": 2000}
+        self.stats = {kind: {"hits": 0, "misses": 0, "expired": 0, "evictions": 0} for kind in self.ttl}
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS note_cache (
+                note_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (note_id, kind)
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_note_cache_lru ON note_cache (kind, accessed_at)")
+        self.db.commit()
+
+    @staticmethod
+    def key(article_url: str) -> str:
+        """按笔记 id 归一化，忽略 xsec_token 等查询参数"""
+        parsed = urlparse(article_url)
+        return note_id_from_url(article_url) or f"{parsed.netloc}{parsed.path}"
+
+    def get(self, kind: str, note_id: str) -> Optional[Dict[str, Any]]:
+        row = self.db.execute(
+            "SELECT payload, created_at FROM note_cache WHERE note_id = ? AND kind = ?", (note_id, kind)
+        ).fetchone()
+        now = time.time()
+        if row is None:
+            self.stats[kind]["misses"] += 1
+            return None
+        payload, created_at = row
+        if now - created_at > self.ttl[kind]:
+            self.stats[kind]["expired"] += 1
+            self.stats[kind]["misses"] += 1
+            self.db.execute("DELETE FROM note_cache WHERE note_id = ? AND kind = ?", (note_id, kind))
+            self.db.commit()
+            return None
+        self.stats[kind]["hits"] += 1
+        self.db.execute("UPDATE note_cache SET accessed_at = ? WHERE note_id = ? AND kind = ?", (now, note_id, kind))
+        self.db.commit()
+        return json.loads(payload)
+
+    def put(self, kind: str, note_id: str, payload: Dict[str, Any]):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO note_cache (note_id, kind, payload, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (note_id, kind, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        evicted = self.db.execute("""
+            DELETE FROM note_cache WHERE kind = ? AND note_id IN (
+                SELECT note_id FROM note_cache WHERE kind = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (kind, kind, self.max_entries[kind])).rowcount
+        self.stats[kind]["evictions"] += max(evicted, 0)
+        self.db.commit()
+
+    def status(self) -> Dict[str, Any]:
+        sizes = dict(self.db.execute("SELECT kind, COUNT(*) FROM note_cache GROUP BY kind").fetchall())
+        return {
+            kind: {**stats, "size": sizes.get(kind, 0), "max_entries": self.max_entries[kind], "ttl": self.ttl[kind]}
+            for kind, stats in self.stats.items()
+        }
+
+
+class CommentWatermarks:
+    """
+    评论增量监控的水位记录，持久化到 SQLite：每篇笔记已见过的评论 id 及首次发现时的序号，
+    以及最新评论时间；游标即序号，返回序号大于游标的评论就是增量
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS comment_seen (
+                note_id TEXT NOT NULL,
+                comment_id TEXT NOT NULL,
+                parent_id TEXT,
+                seq INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (note_id, comment_id)
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_comment_seen_seq ON comment_seen (note_id, seq)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS comment_watermark (
+                note_id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                latest_at INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+
+    def get(self, note_id: str) -> Optional[Dict[str, int]]:
+        row = self.db.execute("SELECT seq, latest_at FROM comment_watermark WHERE note_id = ?", (note_id,)).fetchone()
+        return {"seq": row[0], "latest_at": row[1]} if row else None
+
+    def seen_ids(self, note_id: str) -> set[str]:
+        return {row[0] for row in self.db.execute("SELECT comment_id FROM comment_seen WHERE note_id = ?", (note_id,))}
+
+    def commit(self, note_id: str, new: list[Dict[str, Any]], old: list[Dict[str, Any]]) -> int:
+        """
+        记录一次抓取：new 为新评论，分配新序号；old 为早于水位但此前未见过的评论，以序号 0 记为已见，不作为增量返回
+        返回当前序号
+        """
+        mark = self.get(note_id) or {"seq": 0, "latest_at": 0}
+        seq = mark["seq"] + 1 if new else mark["seq"]
+        latest_at = max([mark["latest_at"]] + [c["created_at"] for c in new + old])
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO comment_seen (note_id, comment_id, parent_id, seq, created_at, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(note_id, c["id"], c["parent_id"], number, c["created_at"], json.dumps(c, ensure_ascii=False))
+                 for number, batch in ((seq, new), (0, old)) for c in batch]
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO comment_watermark (note_id, seq, latest_at, updated_at) VALUES (?, ?, ?, ?)",
+                (note_id, seq, latest_at, time.time())
+            )
+        return seq
+
+    def delta(self, note_id: str, since_seq: int) -> list[Dict[str, Any]]:
+        rows = self.db.execute(
+            "SELECT payload FROM comment_seen WHERE note_id = ? AND seq > ? ORDER BY created_at, seq",
+            (note_id, since_seq)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def status(self) -> Dict[str, Any]:
+        notes, comments = self.db.execute(
+            "SELECT COUNT(DISTINCT note_id), COUNT(*) FROM comment_seen"
+        ).fetchone()
+        return {"notes": notes, "seen_comments": comments}
+
+
 # MCP服务实例
 mcp = FastMCP("Xiaohongshu", port=10001, host='0.0.0.0')
 
 browsers = {
-    "theone": XiaohongshuBrowser("http://192.168.3.7:9222"),
-    "rongyao30": XiaohongshuBrowser("http://192.168.3.72:9222"),
-    "mi6": XiaohongshuBrowser("http://192.168.3.18:9222"),
+    "theone": XiaohongshuBrowser("http://192.168.3.7:9222", capture_api=True),
+    # 手机上的浏览器内存有限，标签页更早回收
+    "rongyao30": XiaohongshuBrowser("http://192.168.3.72:9222", capture_api=True,
+                                    recycle=RecyclePolicy(max_navigations=60, max_heap_mb=150, max_dom_nodes=15000)),
+    "mi6": XiaohongshuBrowser("http://192.168.3.18:9222", capture_api=True,
+                              recycle=RecyclePolicy(max_navigations=30, max_heap_mb=100, max_dom_nodes=10000)),
 }
 
+cdp_prober = CdpProber()
+scheduler = BrowserScheduler(browsers)
 
-async def select_active_browser() -> XiaohongshuBrowser:
-    for browser_id, browser in browsers.items():
+# 写操作限流：类型 -> (突发容量, 每个令牌的补充间隔秒数)，评论间隔建议 >30s
+rate_limiter = RateLimiter({
+    "comment": (1, 30),
+    "note": (1, 300),
+})
+
+note_cache = NoteCache(Path(__file__).resolve().parent / "xiaohongshu_cache.sqlite3")
+comment_watermarks = CommentWatermarks(Path(__file__).resolve().parent / "xiaohongshu_watermarks.sqlite3")
+
+
+async def select_active_browser(account: Optional[str] = None) -> XiaohongshuBrowser:
+    for browser_id in scheduler.candidates(account):
+        browser = browsers[browser_id]
         try:
             await browser._ensure_browser()
             print(f"优先使用 {browser_id} 浏览器")
             return browser
         except Exception as e:
             print(e)
+            scheduler.mark_down(browser_id)
 
     print(f"没有可用浏览器")
     raise RuntimeError("没有可用浏览器")
 
 
-async def preferred_browser() -> XiaohongshuBrowser:
-    browser = await select_active_browser()
-    ok = await browser._check_login_status()
-    if ok:
-        return browser
-    print(f"未登录小红书账号")
+async def preferred_browser(account: Optional[str] = None,
+                            affinity_key: Optional[str] = None) -> XiaohongshuBrowser:
+    connected = False
+    for browser_id in scheduler.candidates(account, affinity_key):
+        browser = browsers[browser_id]
+        try:
+            with metrics.span("select"):
+                await browser._ensure_browser()
+        except Exception as e:
+            print(e)
+            scheduler.mark_down(browser_id)
+            continue
+        connected = True
+        with metrics.span("login"):
+            logged_in = await browser._check_login_status()
+        if logged_in:
+            print(f"优先使用 {browser_id} 浏览器")
+            scheduler.bind(affinity_key, browser_id)
+            return browser
+        print(f"{browser_id} 未登录小红书账号")
+
+    if not connected:
+        print(f"没有可用浏览器")
+        raise RuntimeError("没有可用浏览器")
     raise RuntimeError("未登录小红书账号")
 
 
+@asynccontextmanager
+async def leased_page(account: Optional[str] = None, affinity_key: Optional[str] = None,
+                      resources: str = "full", tool: Optional[str] = None,
+                      rate_limit: Optional[str] = None, max_wait: Optional[float] = None):
+    """
+    选择已登录的浏览器并从其页面池租借一个标签页，退出时自动归还
+    args:
+        account: 指定账号（浏览器 id），写操作需要固定账号时使用
+        affinity_key: 粘滞键，相同键的请求在有效期内优先落到同一浏览器
+        resources: 资源策略，只读工具用 "text" 拦截图片/视频/字体/埋点，写操作保持 "full"
+        tool: 调用方工具名，用于统计
+        rate_limit: 写操作限流类型（"comment" / "note"），在租借页面前按账号排队
+        max_wait: 限流排队的最长等待秒数，超过则直接拒绝；None 表示一直排队
+    """
+    browser = await preferred_browser(account, affinity_key)
+    metrics.label_browser(scheduler.name_of(browser))
+    if rate_limit:
+        with metrics.span("rate_limit"):
+            await rate_limiter.acquire(scheduler.name_of(browser), rate_limit, max_wait)
+    async with scheduler.track(scheduler.name_of(browser)):
+        async with browser.pool.lease() as page:
+            async with tracer.record(browser.context, scheduler.name_of(browser)):
+                async with ResourceBlocker(page, resources, tool, browser.pool):
+                    yield page
+
+
+async def warm_up_browsers():
+    """服务启动时并发连接所有浏览器，避免首个请求承担连接开销"""
+    start = time.perf_counter()
+    # 先并发探测一轮端点，失联主机直接跳过，不再逐个等待连接超时
+    await cdp_prober.probe_all([b.cdp_url for b in browsers.values()])
+    results = await asyncio.gather(*(b._ensure_browser() for b in browsers.values()), return_exceptions=True)
+    for browser_id, result in zip(browsers, results):
+        if isinstance(result, Exception):
+            print(f"预热 {browser_id} 浏览器失败: {result}")
+            scheduler.mark_down(browser_id)
+        else:
+            print(f"预热 {browser_id} 浏览器完成")
+    print(f"浏览器预热耗时 {time.perf_counter() - start:.2f}s")
+
+
 async def clean_browsers():
-    for b in browsers.values():
+    await asyncio.gather(*(b._close_browser() for b in browsers.values()), return_exceptions=True)
+    for closer in (cdp_prober.close, stop_shared_playwright, image_fetcher.close):
         try:
-            await b._close_browser()
-        except:
-            continue
+            await closer()
+        except Exception:
+            pass
     return {"success": True, "message": "浏览器资源已完全清理"}
 
-import asyncio
 def handle_shutdown(signum, frame):
     """处理关机信号"""
     print(f"接收到关机信号 {signum}, 正在清理资源...")    
@@ -212,242 +1761,959 @@ def cleanup():
     print("资源清理完成")
 
 
-# @mcp.tool()
-async def scroll():
-    page = (await preferred_browser()).page
-    await page.evaluate("""
-        const scroller = document.querySelector('.note-scroller');
-        if (scroller) scroller.scrollTop = scroller.scrollHeight;
-    """)
-    await page.wait_for_timeout(2000)
-    return {"success": True, "message": "滚动完成"}
-
-
 @mcp.tool()
-async def login() -> Dict[str, Any]:
-    """小红书登录"""
-    bowser = await select_active_browser()
+@metrics.timed
+async def login(account: Optional[str] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    小红书登录
+    args:
+        account: 要登录的账号（浏览器 id），不填则由调度器选择
+        timeout: 调用超时（秒），超时后中断操作并重置标签页；不填则最多等待手动登录 120s
+    """
+    bowser = await select_active_browser(account)
     await bowser._check_login_status()
     try:
         if bowser.is_logged_in:
             return {"success": True, "message": "已是登录状态"}
 
-        await bowser.page.goto("https://www.xiaohongshu.com/", wait_until="domcontentloaded")
-        # 这里建议人工扫码或手动登录
-        print("请手动完成登录...")
-        await bowser.page.wait_for_selector(".reds-avatar", timeout=120000)
+        async with call_deadline(timeout):
+            async with bowser.pool.lease() as page:
+                await page.goto("https://www.xiaohongshu.com/", wait_until="domcontentloaded")
+                # 这里建议人工扫码或手动登录
+                print("请手动完成登录...")
+                await page.wait_for_selector(".reds-avatar", timeout=remaining_ms(120000))
         bowser.is_logged_in = True
+        bowser.login_checked_at = time.monotonic()
         await bowser._save_session()
         return {"success": True, "message": "登录成功"}
-    except PlaywrightTimeoutError:
+    except (PlaywrightTimeoutError, TimeoutError):
         return {"success": False, "message": "登录超时，请检查是否完成登录"}
     except Exception as e:
         return {"success": False, "message": f"登录失败: {str(e)}"}
 
 
-# @mcp.tool()
-async def get_current_page_articles() -> Dict[str, Any]:
-    return await parse_current_page_articles()
+# 笔记卡片字段选择器表：字段 -> (卡片内选择器, 取值属性)，"text" 表示取 innerText
+NOTE_CARD_ITEM = ".note-item"
+NOTE_CARD_SELECTORS = {
+    "title": (".footer .title", "text"),
+    "author": (".author .name", "text"),
+    "link": (".cover, .mask, .ld", "href"),
+    "like": (".footer .like-wrapper .count", "text"),
+    "cover": (".cover img, img", "src"),
+}
+
+# 在页面内一次性提取所有卡片的全部字段，避免逐元素的 CDP 往返
+EXTRACT_CARDS_JS = """
+([item, fields]) => Array.from(document.querySelectorAll(item)).map(card => {
+    const out = {};
+    for (const [name, [selector, attr]] of Object.entries(fields)) {
+        const el = card.querySelector(selector);
+        if (!el) { out[name] = ""; continue; }
+        out[name] = attr === "text" ? el.innerText : (el[attr] || el.getAttribute(attr) || "");
+    }
+    return out;
+})
+"""
+
+NOTE_ID_PATTERN = re.compile(r"/([0-9a-f]{24})(?:[/?#]|$)")
+
+
+def note_id_from_url(url: str) -> str:
+    """从笔记链接中提取笔记 id（/explore/<id>、/search_result/<id> 等）"""
+    match = NOTE_ID_PATTERN.search(urlparse(url).path + "/") if url else None
+    return match.group(1) if match else ""
+
 
-async def parse_current_page_articles() -> Dict[str, Any]:
-    """获取当前页面笔记列表"""
+async def parse_current_page_articles(page: Page) -> Dict[str, Any]:
+    """获取当前页面笔记列表（单次 evaluate 往返提取全部卡片）"""
     try:
-        page = (await preferred_browser()).page
+        cards = await page.evaluate(EXTRACT_CARDS_JS, [NOTE_CARD_ITEM, NOTE_CARD_SELECTORS])
         articles = []
-        article_elements = await page.query_selector_all(".note-item")
-        for element in article_elements:
-            try:
-                title_elem = await element.query_selector(".footer .title")
-                title = await title_elem.inner_text() if title_elem else ""
-                link_elem = await element.query_selector(".cover, .mask, .ld")
-                link = await link_elem.evaluate("el => el.href") if link_elem else ""
-                author_elem = await element.query_selector(".author .name")
-                author = await author_elem.inner_text() if author_elem else ""
-                like_elem = await element.query_selector(".footer .like-wrapper .count")
-                like = await like_elem.inner_text() if like_elem else ""
-                articles.append({
-                    "title": title.strip(),
-                    "author": author.strip(),
-                    "link": link,
-                    "like": like.strip(),
-                })
-            except Exception as e:
-                continue
+        for card in cards:
+            article = {key: (value or "").strip() for key, value in card.items()}
+            article["note_id"] = note_id_from_url(article.get("link", ""))
+            articles.append(article)
         return {
             "success": True,
             "articles": articles,
-            "count": len(articles)
+            "count": len(articles),
+            "source": "dom",
         }
     except Exception as e:
         return {"success": False, "message": f"搜索失败: {str(e)}"}
 
 
-# @mcp.tool()
-async def search_articles(keyword: str, ) -> Dict[str, Any]:
+async def report_batch(ctx: Optional[Context], progress: int, total: int, batch: list[Dict[str, Any]]):
+    """通过 MCP 进度通知把一批结果推送给客户端（客户端未提供 progressToken 时忽略）"""
+    if ctx is None or not batch:
+        return
+    try:
+        await ctx.report_progress(progress, total, json.dumps(batch, ensure_ascii=False))
+    except Exception as e:
+        print(f"进度通知发送失败: {str(e)}")
+
+
+@mcp.tool()
+@metrics.timed
+async def search_articles(keyword: str, max_results: int = 20, cursor: Optional[str] = None,
+                          time_budget: float = 60, ctx: Context = None) -> Dict[str, Any]:
     """
-    搜索笔记
+    搜索笔记，持续滚动结果流并按笔记 id 去重，每批新结果通过进度通知推送
     args:
         keyword: 搜索关键字
+        max_results: 本次最多返回的笔记数量
+        cursor: 上次返回的 next_cursor，用于继续获取后续结果。cursor 只是已返回的条数，
+                续页会重新打开搜索页并滚动经过前面的全部结果，翻到越后面越慢；需要大量结果时应调大 max_results 一次取完
+        time_budget: 时间预算（秒），到期时中断正在进行的滚动/等待并返回已获取的结果
     """
     try:
-        page = (await preferred_browser()).page
-        await page.goto(f"https://www.xiaohongshu.com/search_result?keyword={keyword}",
-                        wait_until="domcontentloaded")
-        await page.wait_for_timeout(2000)
-        return await parse_current_page_articles()
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        return {"success": False, "message": f"无效的 cursor: {cursor}"}
+    target = offset + max_results
+    deadline = time.monotonic() + time_budget
+    seen: set[str] = set()
+    articles: list[Dict[str, Any]] = []
+    source = "dom"
+    exhausted = False
+    timed_out = False
+    try:
+        async with call_deadline(time_budget):
+            async with leased_page(resources="text", tool="search_articles") as page:
+                capture = capture_for(page)
+                waiter = capture.expect(page, "search") if capture else None
+                with metrics.span("navigate"):
+                    await page.goto(f"https://www.xiaohongshu.com/search_result?keyword={quote(keyword)}",
+                                    wait_until="domcontentloaded")
+                if not waiter:
+                    await readiness.wait(page, "search.first_page", CountSettled(NOTE_CARD_ITEM), replaces_ms=2000)
+                stale = 0
+                while len(articles) < target and time.monotonic() < deadline:
+                    # 优先使用接口数据，未捕获到时解析页面卡片
+                    with metrics.span("wait"):
+                        cards = await capture.wait(waiter, timeout=3) if waiter else None
+                    if cards:
+                        batch = [asdict(card) for card in cards]
+                        source = "api"
+                    else:
+                        with metrics.span("extract"):
+                            parsed = await parse_current_page_articles(page)
+                        batch = parsed.get("articles", [])
+
+                    added = 0
+                    fresh = []
+                    for article in batch:
+                        # 同一笔记在不同链接中的 xsec_token 不同，按笔记 id 去重
+                        key = article.get("note_id") or article.get("link")
+                        if not key or key in seen:
+                            continue
+                        seen.add(key)
+                        articles.append(article)
+                        added += 1
+                        if offset < len(articles) <= target:
+                            fresh.append(article)
+                    await report_batch(ctx, min(len(articles), target) - offset, max_results, fresh)
+
+                    # 连续多次滚动没有新结果，视为结果流已到底
+                    stale = 0 if added else stale + 1
+                    if stale >= 2:
+                        exhausted = True
+                        break
+                    if len(articles) >= target:
+                        break
+                    waiter = capture.expect(page, "search") if capture else None
+                    idle = None if waiter else RouteIdle(page, re.escape(ResponseCapture.ROUTES["search"][0]))
+                    await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+                    if idle:
+                        # 没有接口捕获时，等下一页接口结束且卡片数量稳定
+                        await readiness.wait(page, "search.next_page", idle,
+                                             CountSettled(NOTE_CARD_ITEM, quiet_ms=200), replaces_ms=1500)
+    except TimeoutError:
+        # 预算耗尽时中断正在进行的操作，标签页由页面池重置，已获取的结果照常返回
+        timed_out = True
     except Exception as e:
         return {"success": False, "message": f"搜索失败: {str(e)}"}
 
+    result = articles[offset:target]
+    return {
+        "success": True,
+        "articles": result,
+        "count": len(result),
+        "next_cursor": None if exhausted else str(offset + len(result)),
+        "exhausted": exhausted,
+        "timed_out": timed_out,
+        "source": source,
+    }
+
 
-# @mcp.tool()
-async def get_article_content(article_url: str) -> Dict[str, Any]:
+@mcp.tool()
+@metrics.timed
+async def get_article_content(article_url: str, force_refresh: bool = False, mode: str = "auto",
+                              timeout: Optional[float] = None) -> Dict[str, Any]:
     """
     获取笔记内容
     args:
         article_url: 笔记的url
+        force_refresh: 忽略缓存，强制重新获取
+        mode: "headless" 直接请求页面 HTML 解析服务端渲染数据，不占用标签页；"tab" 打开标签页获取；
+              "auto"（默认）先用 headless，失败时回退到标签页
+        timeout: 调用超时（秒），超时后中断操作并重置标签页；不填则不限时
     """
+    if mode not in ("auto", "headless", "tab"):
+        return {"success": False, "message": f"不支持的获取方式: {mode}"}
+    note_id = note_cache.key(article_url)
+    if not force_refresh and (cached := note_cache.get("content", note_id)):
+        return {**cached, "cached": True}
+    result = {"success": False, "message": "未获取"}
+    try:
+        async with call_deadline(timeout):
+            if mode in ("auto", "headless"):
+                result = await _fetch_article_ssr(article_url)
+                if not result["success"]:
+                    print(f"headless 获取笔记失败: {result['message']}")
+            if not result["success"] and mode in ("auto", "tab"):
+                result = await _fetch_article_content(article_url)
+    except TimeoutError:
+        return {"success": False, "message": f"获取笔记超时（{timeout}s）"}
+    if result["success"]:
+        note_cache.put("content", note_id, result)
+    return result
+
+
+async def _fetch_article_ssr(article_url: str) -> Dict[str, Any]:
+    """用浏览器上下文的请求接口（携带其 cookies）获取笔记页面 HTML，解析内嵌的初始数据，不打开标签页"""
     try:
-        page = (await preferred_browser()).page
-        await page.goto(article_url, wait_until="domcontentloaded")
-        await page.wait_for_timeout(3000)
-        content_elements = await page.query_selector_all(".desc .note-text")
-        for element in content_elements:
-            content = await element.inner_text()
-            return {"success": True, "content": content.strip()}
+        browser = await preferred_browser()
+        browser_id = scheduler.name_of(browser)
+        metrics.label_browser(browser_id)
+        async with scheduler.track(browser_id):
+            with metrics.span("navigate"):
+                status, html = await browser.fetch_html(article_url)
+            if status != 200:
+                return {"success": False, "message": f"请求笔记页面失败: HTTP {status}"}
+        with metrics.span("extract"):
+            detail = parse_initial_state(html, note_cache.key(article_url))
+        if not detail:
+            return {"success": False, "message": "页面中未找到笔记初始数据"}
+        return {"success": True, "content": detail.content, "note": asdict(detail), "source": "ssr"}
+    except Exception as e:
+        return {"success": False, "message": f"headless 获取失败: {str(e)}"}
+
+
+async def _fetch_article_content(article_url: str) -> Dict[str, Any]:
+    try:
+        async with leased_page(resources="text", tool="get_article_content") as page:
+            capture = capture_for(page)
+            waiter = capture.expect(page, "feed") if capture else None
+            with metrics.span("navigate"):
+                await page.goto(article_url, wait_until="domcontentloaded")
+            if waiter:
+                with metrics.span("wait"):
+                    detail = await capture.wait(waiter, timeout=3)
+                if detail:
+                    return {"success": True, "content": detail.content, "note": asdict(detail), "source": "api"}
+            else:
+                await readiness.wait(page, "content.text", ElementState(".desc .note-text", "attached"),
+                                     replaces_ms=3000)
+            with metrics.span("extract"):
+                content_elements = await page.query_selector_all(".desc .note-text")
+                for element in content_elements:
+                    content = await element.inner_text()
+                    return {"success": True, "content": content.strip()}
         return {"success": False, "message": "未找到内容"}
     except Exception as e:
         return {"success": False, "message": f"搜索失败: {str(e)}"}
 
 
-# @mcp.tool()
-async def view_article_comments(article_url: str, limit: int = 20) -> Dict[str, Any]:
+# 评论字段选择器表：字段 -> (按优先级尝试的选择器列表, 取值属性)，属性为 None 表示取 innerText
+COMMENT_PARENT = ".comments-container .list-container .parent-comment"
+COMMENT_SUB = ".comment-item-sub"
+COMMENT_SHOW_MORE = ".reply-container .show-more"
+COMMENT_FIELDS = {
+    "username": ([".author .name", ".author"], None),
+    "content": ([".content .note-text", ".content", ".note-text"], None),
+    "date": ([".info .date > span:not(.location)"], None),
+    "location": ([".info .date > .location"], None),
+    "like": ([".like .count", ".like-wrapper .count"], None),
+}
+
+# 在页面内完成滚动加载、并发展开回复与整棵评论树的提取，以 DOM 变化代替固定等待
+HARVEST_COMMENTS_JS = """
+async ({limit, maxExpand, concurrency, settleMs, budgetMs, parentSel, subSel, moreSel, fields}) => {
+    const deadline = Date.now() + budgetMs;
+    const scroller = document.querySelector('.note-scroller');
+    // 等待目标节点出现 DOM 变化，超时返回 false
+    const changed = (target, timeout) => new Promise(resolve => {
+        const obs = new MutationObserver(() => { obs.disconnect(); clearTimeout(timer); resolve(true); });
+        const timer = setTimeout(() => { obs.disconnect(); resolve(false); },
+            Math.max(0, Math.min(timeout, deadline - Date.now())));
+        obs.observe(target, {childList: true, subtree: true});
+    });
+    const parents = () => document.querySelectorAll(parentSel);
+
+    // 1. 滚动加载父评论，直到满足 limit、连续多次不再增长或超出预算
+    let stale = 0;
+    while (scroller && parents().length < limit && stale < 3 && Date.now() < deadline) {
+        const before = parents().length;
+        const target = document.querySelector('.comments-container') || scroller;
+        const wait = changed(target, settleMs);
+        scroller.scrollTop = scroller.scrollHeight;
+        await wait;
+        stale = parents().length > before ? 0 : stale + 1;
+    }
+
+    // 2. 并发展开各父评论下的回复，每个父评论最多展开 maxExpand 次
+    const targets = Array.from(parents()).slice(0, limit);
+    let expanded = 0;
+    const expand = async parent => {
+        for (let i = 0; i < maxExpand && Date.now() < deadline; i++) {
+            const btn = parent.querySelector(moreSel);
+            if (!btn) break;
+            const wait = changed(btn.closest('.reply-container') || parent, settleMs * 2);
+            btn.click();
+            if (!(await wait)) break;
+            expanded++;
+        }
+    };
+    const queue = targets.slice();
+    await Promise.all(Array.from({length: Math.max(1, concurrency)}, async () => {
+        while (queue.length) await expand(queue.shift());
+    }));
+
+    // 3. 一次性提取整棵评论树
+    const pick = (root, selectors, attr) => {
+        for (const selector of selectors) {
+            const el = root.querySelector(selector);
+            if (el) return attr ? (el.getAttribute(attr) || '') : el.innerText;
+        }
+        return '';
+    };
+    const read = el => {
+        const out = {id: el.id || el.getAttribute('data-id') || ''};
+        for (const [name, [selectors, attr]] of Object.entries(fields)) out[name] = pick(el, selectors, attr);
+        return out;
+    };
+    const comments = targets.map(parent => {
+        const main = parent.querySelector('.comment-item:not(' + subSel + ')') || parent;
+        return {
+            ...read(main),
+            replies: Array.from(parent.querySelectorAll(subSel)).map(read),
+            has_more_replies: !!parent.querySelector(moreSel),
+        };
+    });
+    return {comments, expanded, loaded: parents().length, timedOut: Date.now() >= deadline};
+}
+"""
+
+
+def parse_count(text: str) -> int:
+    """解析页面上的计数文本，如 "1.2万"、"3k"、"赞"（无数值时为 0）"""
+    text = (text or "").strip().lower().replace("+", "")
+    match = re.match(r"^([\d.]+)\s*(万|w|k|千)?", text)
+    if not match:
+        return 0
+    value = float(match.group(1))
+    unit = match.group(2)
+    if unit in ("万", "w"):
+        value *= 10000
+    elif unit in ("k", "千"):
+        value *= 1000
+    return int(value)
+
+
+def _normalize_comment(raw: Dict[str, Any]) -> Dict[str, Any]:
+    comment = {key: (raw.get(key) or "").strip() for key in COMMENT_FIELDS}
+    comment["like"] = parse_count(comment["like"])
+    comment_id = (raw.get("id") or "").removeprefix("comment-")
+    if not comment_id:
+        # 页面未提供 id 时，用作者/内容/时间生成稳定 id
+        digest = hashlib.sha1(f"{comment['username']}|{comment['content']}|{comment['date']}".encode())
+        comment_id = digest.hexdigest()[:16]
+    comment["id"] = comment_id
+    return comment
+
+
+async def harvest_comments(page: Page, limit: int = 20, max_expand: int = 5, concurrency: int = 4,
+                           settle_ms: int = 1500, budget_ms: int = 30000) -> Dict[str, Any]:
+    """
+    在当前笔记页内单次 evaluate 获取评论树
+    args:
+        limit: 父评论数量上限
+        max_expand: 每条父评论最多点击“展开更多回复”的次数
+        concurrency: 同时展开的父评论数
+        settle_ms: 等待 DOM 变化的超时时间
+        budget_ms: 整体时间预算
+    """
+    result = await page.evaluate(HARVEST_COMMENTS_JS, {
+        "limit": limit,
+        "maxExpand": max_expand,
+        "concurrency": concurrency,
+        "settleMs": settle_ms,
+        "budgetMs": budget_ms,
+        "parentSel": COMMENT_PARENT,
+        "subSel": COMMENT_SUB,
+        "moreSel": COMMENT_SHOW_MORE,
+        "fields": COMMENT_FIELDS,
+    })
+    comments = []
+    for raw in result["comments"]:
+        comment = _normalize_comment(raw)
+        comment["replies"] = [_normalize_comment(sub) for sub in raw["replies"]]
+        comment["has_more_replies"] = raw["has_more_replies"]
+        comments.append(comment)
+    return {"comments": comments, "expanded": result["expanded"], "loaded": result["loaded"],
+            "timed_out": result.get("timedOut", False)}
+
+
+@dataclass
+class NoteCard:
+    """搜索结果中的笔记卡片"""
+    note_id: str
+    title: str
+    author: str
+    link: str
+    like: str
+    cover: str
+    xsec_token: str = ""
+
+
+@dataclass
+class NoteDetail:
+    """笔记详情"""
+    note_id: str
+    title: str
+    content: str
+    author: str
+    tags: list[str] = field(default_factory=list)
+    images: list[str] = field(default_factory=list)
+    like: int = 0
+    collect: int = 0
+    comment: int = 0
+    share: int = 0
+
+
+@dataclass
+class CommentRecord:
+    """评论，replies 为其下已加载的子评论"""
+    id: str
+    username: str
+    content: str
+    date: str
+    location: str
+    like: int
+    replies: list["CommentRecord"] = field(default_factory=list)
+    has_more_replies: bool = False
+    created_at: int = 0  # 发布时间（毫秒时间戳），页面采集时为 0
+
+
+@dataclass
+class CommentPage:
+    """一页评论接口数据"""
+    comments: list[CommentRecord]
+    cursor: str
+    has_more: bool
+
+
+def note_link(note_id: str, xsec_token: str = "") -> str:
+    link = f"https://www.xiaohongshu.com/explore/{note_id}"
+    return f"{link}?xsec_token={xsec_token}&xsec_source=pc_search" if xsec_token else link
+
+
+def decode_search(data: Dict[str, Any]) -> list[NoteCard]:
+    cards = []
+    for item in data.get("items") or []:
+        card = item.get("note_card")
+        if item.get("model_type") != "note" or not card:
+            continue
+        cards.append(NoteCard(
+            note_id=item["id"],
+            title=card.get("display_title") or "",
+            author=(card.get("user") or {}).get("nickname") or "",
+            link=note_link(item["id"], item.get("xsec_token") or ""),
+            like=str((card.get("interact_info") or {}).get("liked_count") or ""),
+            cover=(card.get("cover") or {}).get("url_default") or "",
+            xsec_token=item.get("xsec_token") or "",
+        ))
+    return cards
+
+
+def decode_note(card: Dict[str, Any]) -> NoteDetail:
+    interact = card.get("interact_info") or {}
+    return NoteDetail(
+        note_id=card.get("note_id") or "",
+        title=card.get("title") or "",
+        content=card.get("desc") or "",
+        author=(card.get("user") or {}).get("nickname") or "",
+        tags=[tag.get("name") or "" for tag in card.get("tag_list") or []],
+        images=[image.get("url_default") or image.get("url") or "" for image in card.get("image_list") or []],
+        like=parse_count(str(interact.get("liked_count") or "")),
+        collect=parse_count(str(interact.get("collected_count") or "")),
+        comment=parse_count(str(interact.get("comment_count") or "")),
+        share=parse_count(str(interact.get("share_count") or "")),
+    )
+
+
+def decode_feed(data: Dict[str, Any]) -> Optional[NoteDetail]:
+    items = data.get("items") or []
+    return decode_note(items[0]["note_card"]) if items and items[0].get("note_card") else None
+
+
+def decode_comment(raw: Dict[str, Any]) -> CommentRecord:
+    create_time = raw.get("create_time")
+    return CommentRecord(
+        id=raw.get("id") or "",
+        username=(raw.get("user_info") or {}).get("nickname") or "",
+        content=raw.get("content") or "",
+        date=datetime.fromtimestamp(create_time / 1000).strftime("%Y-%m-%d %H:%M") if create_time else "",
+        location=raw.get("ip_location") or "",
+        like=parse_count(str(raw.get("like_count") or "")),
+        replies=[decode_comment(sub) for sub in raw.get("sub_comments") or []],
+        has_more_replies=bool(raw.get("sub_comment_has_more")),
+        created_at=int(create_time or 0),
+    )
+
+
+# 笔记页面内嵌的服务端渲染数据，是 JS 对象字面量（含 undefined），不是严格的 JSON
+INITIAL_STATE_PATTERN = re.compile(r"window\.__INITIAL_STATE__\s*=\s*(\{.*?\})\s*;?\s*</script>", re.S)
+# 字符串字面量整体先被匹配并原样保留，只替换字符串之外的 undefined
+JS_UNDEFINED_PATTERN = re.compile(r'("(?:[^"\\]|\\.)*")|(?<=[:\[,])undefined(?=[,\]}])', re.S)
+
+
+def snake_keys(value: Any) -> Any:
+    """递归把 camelCase 键转为 snake_case，使页面数据与接口数据共用解析函数"""
+    if isinstance(value, dict):
+        return {re.sub(r"(?<!^)(?=[A-Z])", "_", key).lower(): snake_keys(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [snake_keys(item) for item in value]
+    return value
+
+
+def parse_initial_state(html: str, note_id: str = "") -> Optional[NoteDetail]:
+    """从笔记页面 HTML 中解析 window.__INITIAL_STATE__ 里的笔记详情"""
+    match = INITIAL_STATE_PATTERN.search(html)
+    if not match:
+        return None
+    state = json.loads(JS_UNDEFINED_PATTERN.sub(lambda token: token.group(1) or "null", match.group(1)))
+    detail_map = (state.get("note") or {}).get("noteDetailMap") or {}
+    entry = detail_map.get(note_id) or next(
+        (item for item in detail_map.values() if ((item or {}).get("note") or {}).get("noteId")), None
+    )
+    card = (entry or {}).get("note")
+    if not card or not card.get("noteId"):
+        return None
+    return decode_note(snake_keys(card))
+
+
+def decode_comments(data: Dict[str, Any]) -> CommentPage:
+    return CommentPage(
+        comments=[decode_comment(raw) for raw in data.get("comments") or []],
+        cursor=data.get("cursor") or "",
+        has_more=bool(data.get("has_more")),
+    )
+
+
+class ResponseCapture:
+    """监听浏览器上下文内的小红书接口响应并解析为结构化记录，工具可在响应到达后立即返回"""
+
+    # 类型 -> (接口路径, 解析函数)
+    ROUTES = {
+        "search": ("/api/sns/web/v1/search/notes", decode_search),
+        "feed": ("/api/sns/web/v1/feed", decode_feed),
+        "comments": ("/api/sns/web/v2/comment/page", decode_comments),
+    }
+
+    def __init__(self, context: BrowserContext, history: int = 50):
+        self.records = deque(maxlen=history)
+        self._waiters: Dict[tuple[Page, str], list[asyncio.Future]] = {}
+        self.stats = {"captured": 0, "decode_errors": 0, "hits": 0, "misses": 0}
+        context.on("response", self._on_response)
+
+    def _on_response(self, response):
+        path = urlparse(response.url).path
+        for kind, (route, decoder) in self.ROUTES.items():
+            if path == route:
+                asyncio.create_task(self._decode(kind, decoder, response))
+                return
+
+    async def _decode(self, kind: str, decoder, response):
+        try:
+            page = response.frame.page
+            body = await response.json()
+            record = decoder(body.get("data") or {})
+        except Exception as e:
+            self.stats["decode_errors"] += 1
+            print(f"解析接口响应失败: {response.url} {str(e)}")
+            return
+        self.stats["captured"] += 1
+        self.records.append({"kind": kind, "url": response.url, "at": time.time()})
+        for future in self._waiters.pop((page, kind), []):
+            if not future.done():
+                future.set_result(record)
+
+    def expect(self, page: Page, kind: str) -> asyncio.Future:
+        """在导航前登记，等待该页面的下一条 kind 类型接口响应"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault((page, kind), []).append(future)
+        return future
+
+    async def wait(self, future: asyncio.Future, timeout: float) -> Any:
+        """等待接口记录，超时返回 None，由调用方回退到 DOM 解析"""
+        try:
+            record = await asyncio.wait_for(future, timeout)
+            self.stats["hits"] += 1
+            return record
+        except asyncio.TimeoutError:
+            self.stats["misses"] += 1
+            self._waiters = {key: alive for key, futures in self._waiters.items()
+                             if (alive := [f for f in futures if not f.done()])}
+            return None
+
+    def status(self) -> Dict[str, Any]:
+        return {**self.stats, "recent": list(self.records)[-5:]}
+
+
+def capture_for(page: Page) -> Optional[ResponseCapture]:
+    for browser in browsers.values():
+        if browser.context is page.context:
+            return browser.capture
+    return None
+
+
+@mcp.tool()
+@metrics.timed
+async def view_article_comments(article_url: str, limit: int = 20, max_expand: int = 5,
+                                force_refresh: bool = False, timeout: Optional[float] = None) -> Dict[str, Any]:
     """
     查看小红书笔记的评论
     args:
         article_url: 笔记的url
         limit: 评论数量
+        max_expand: 每条评论最多展开回复的次数
+        force_refresh: 忽略缓存，强制重新获取
+        timeout: 调用超时（秒），临近超时停止加载与展开，返回已采集的评论（partial 为 true）；不填则不限时
     """
+    note_id = note_cache.key(article_url)
+    cached = None if force_refresh else note_cache.get("comments", note_id)
+    # 缓存的采集范围不小于本次请求时才可复用
+    if cached and cached["limit"] >= limit and cached["max_expand"] >= max_expand:
+        comments = cached["comments"][:limit]
+        return {"success": True, "article_url": article_url, "comments": comments,
+                "count": len(comments), "source": cached["source"], "cached": True}
     try:
-        page = (await preferred_browser()).page
-        await page.goto(article_url, wait_until="domcontentloaded")
-        await page.wait_for_timeout(3000)
-        await page.evaluate("""
-            const scroller = document.querySelector('.note-scroller');
-            if (scroller) scroller.scrollTop = scroller.scrollHeight;
-        """)
-        await page.wait_for_timeout(2000)
-        comments = []
-        comment_elements = await page.query_selector_all(
-            ".comments-container .list-container .parent-comment")
-        for element in comment_elements[:limit]:
-            try:
-                username_elem = await element.query_selector(".author")
-                username = await username_elem.inner_text() if username_elem else ""
-                content_elem = await element.query_selector(".content, .note-text")
-                content = await content_elem.inner_text() if content_elem else ""
-                date_elem = await element.query_selector(".info .date > span:not(.location)")
-                date = await date_elem.inner_text() if date_elem else ""
-                location_elem = await element.query_selector(".info .date > .location")
-                location = await location_elem.inner_text() if location_elem else ""
-                # 子评论递归获取
-                replies = []
-                reply_container = await element.query_selector(".reply-container")
-                if reply_container:
-                    replies = await get_sub_comments(reply_container, max_expand=5)
-
-                comments.append({
-                    "username": username.strip(),
-                    "content": content.strip(),
-                    "date": date.strip(),
-                    "location": location.strip(),
-                    "replies": replies,
-                })
-            except Exception as e:
-                continue
+        async with call_deadline(timeout):
+            result = await _fetch_article_comments(article_url, limit, max_expand)
+    except TimeoutError:
+        return {"success": False, "message": f"获取评论超时（{timeout}s）"}
+    # 未采集完整的结果不缓存
+    if result["success"] and not result.get("partial"):
+        note_cache.put("comments", note_id, {**result, "limit": limit, "max_expand": max_expand})
+    return result
+
+
+async def _fetch_article_comments(article_url: str, limit: int, max_expand: int) -> Dict[str, Any]:
+    try:
+        async with leased_page(resources="text", tool="view_article_comments") as page:
+            capture = capture_for(page)
+            waiter = capture.expect(page, "comments") if capture else None
+            with metrics.span("navigate"):
+                await page.goto(article_url, wait_until="domcontentloaded")
+            await readiness.wait(page, "comments.scroller", ElementState(".note-scroller"), required=True)
+            if waiter:
+                with metrics.span("wait"):
+                    captured = await capture.wait(waiter, timeout=3)
+                # 首屏接口数据已满足数量要求，且无需展开回复（max_expand 为 0 或没有折叠的回复）时直接返回，
+                # 否则回退到页面内采集，接口只带少量预览回复
+                if captured and (len(captured.comments) >= limit or not captured.has_more) and (
+                        max_expand == 0 or not any(c.has_more_replies for c in captured.comments[:limit])):
+                    comments = [asdict(comment) for comment in captured.comments[:limit]]
+                    return {
+                        "success": True,
+                        "article_url": article_url,
+                        "comments": comments,
+                        "count": len(comments),
+                        "source": "api",
+                    }
+            with metrics.span("extract"):
+                # 页面内采集的预算留出余量，临近截止时间时返回已加载的部分
+                tree = await harvest_comments(page, limit=limit, max_expand=max_expand,
+                                              budget_ms=remaining_ms(30000, reserve_ms=1000))
         return {
             "success": True,
             "article_url": article_url,
-            "comments": comments,
-            "count": len(comments)
+            "comments": tree["comments"],
+            "count": len(tree["comments"]),
+            "expanded": tree["expanded"],
+            "partial": tree["timed_out"],
+            "source": "dom",
         }
     except Exception as e:
         return {"success": False, "message": f"获取评论失败: {str(e)}"}
 
 
-async def get_sub_comments(reply_container, max_expand=5):
-    """递归获取子评论，边获取边展开"""
-    replies = []
-    expand_count = 0
-    page = (await preferred_browser()).page
-    while True:
-        # 1. 获取当前已加载的子评论
-        sub_comments = await reply_container.query_selector_all(".comment-item-sub")
-        for sub in sub_comments[len(replies):]:  # 只处理新出现的
-            sub_username_elem = await sub.query_selector(".author .name")
-            sub_username = await sub_username_elem.inner_text() if sub_username_elem else ""
-            sub_content_elem = await sub.query_selector(".content, .note-text")
-            sub_content = await sub_content_elem.inner_text() if sub_content_elem else ""
-            sub_date_elem = await sub.query_selector(".info .date > span:not(.location)")
-            sub_date = await sub_date_elem.inner_text() if sub_date_elem else ""
-            sub_location_elem = await sub.query_selector(".info .date > .location")
-            sub_location = await sub_location_elem.inner_text() if sub_location_elem else ""
-            replies.append({
-                "username": sub_username.strip(),
-                "content": sub_content.strip(),
-                "date": sub_date.strip(),
-                "location": sub_location.strip(),
+def flatten_comments(comments: list[CommentRecord]) -> list[Dict[str, Any]]:
+    """把评论树展开为扁平列表，回复带上所属父评论 id"""
+    flat = []
+    for comment in comments:
+        for record, parent_id in [(comment, None)] + [(reply, comment.id) for reply in comment.replies]:
+            flat.append({
+                "id": record.id,
+                "parent_id": parent_id,
+                "username": record.username,
+                "content": record.content,
+                "date": record.date,
+                "location": record.location,
+                "like": record.like,
+                "created_at": record.created_at,
             })
-        # 2. 判断是否还有“展开更多回复”
-        show_more_btn = await reply_container.query_selector(".show-more")
-        if show_more_btn and expand_count < max_expand:
+    return flat
+
+
+@mcp.tool()
+@metrics.timed
+async def get_new_comments(article_url: str, since_cursor: Optional[str] = None, max_pages: int = 5,
+                           timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    增量获取笔记的新评论：按时间从新到旧翻页，遇到已见过的评论即停止，只返回新增部分
+    args:
+        article_url: 笔记的url
+        since_cursor: 上次返回的 cursor，返回此后新增的评论；不填则只返回本次新发现的评论（首次调用返回第一页作为基线）
+        max_pages: 最多翻的评论页数
+        timeout: 调用超时（秒），超时后中断翻页并重置标签页，已翻过的页面照常记入水位并返回（timed_out 为 true）；
+                 不填则不限时
+    """
+    note_id = note_cache.key(article_url)
+    try:
+        since_seq = int(since_cursor) if since_cursor else None
+    except ValueError:
+        return {"success": False, "message": f"无效的 cursor: {since_cursor}"}
+    mark = comment_watermarks.get(note_id)
+    if since_seq is None:
+        since_seq = mark["seq"] if mark else 0
+    crawl = {"new": [], "old": [], "pages": 0, "reached_seen": False, "source": "api"}
+    timed_out = False
+    try:
+        async with call_deadline(timeout):
+            # 首次调用没有水位，只取第一页作为基线
+            await _crawl_new_comments(article_url, note_id, mark, max_pages if mark else 1, crawl)
+    except TimeoutError:
+        # 每页评论在翻页间整体归类，中断时已翻过的页面是完整的，可以照常提交
+        timed_out = True
+    except Exception as e:
+        return {"success": False, "message": f"获取新评论失败: {str(e)}"}
+    seq = comment_watermarks.commit(note_id, crawl["new"], crawl["old"])
+    comments = comment_watermarks.delta(note_id, since_seq)
+    return {
+        "success": True,
+        "article_url": article_url,
+        "note_id": note_id,
+        "comments": comments,
+        "count": len(comments),
+        "cursor": str(seq),
+        "pages": crawl["pages"],
+        "reached_seen": crawl["reached_seen"],
+        "timed_out": timed_out,
+        "source": crawl["source"],
+    }
+
+
+async def _crawl_new_comments(article_url: str, note_id: str, mark: Optional[Dict[str, int]],
+                              max_pages: int, crawl: Dict[str, Any]):
+    """翻页归类新评论，结果逐页写入 crawl，调用被中断时调用方仍可提交已翻过的部分"""
+    seen = comment_watermarks.seen_ids(note_id)
+    latest_at = mark["latest_at"] if mark else 0
+    new: list[Dict[str, Any]] = crawl["new"]
+    old: list[Dict[str, Any]] = crawl["old"]
+
+    def classify(flat: list[Dict[str, Any]]) -> bool:
+        """归类一页评论，返回是否已翻到水位：该页最后一条父评论已见过或早于水位时间"""
+        reached = True
+        for comment in flat:
+            known = comment["id"] in seen
+            if not known:
+                seen.add(comment["id"])
+                # 早于水位时间的未见评论（如上次未翻到的旧评论）只记为已见，不算新增
+                known = bool(latest_at and comment["created_at"] and comment["created_at"] <= latest_at)
+                (old if known else new).append(comment)
+            if comment["parent_id"] is None:
+                # 置顶/热门评论可能排在最前，只看最后一条父评论判断是否越过水位
+                reached = known
+        return reached
+
+    async with leased_page(resources="text", tool="get_new_comments", affinity_key=f"comments:{note_id}") as page:
+        capture = capture_for(page)
+        waiter = capture.expect(page, "comments") if capture else None
+        with metrics.span("navigate"):
+            await page.goto(article_url, wait_until="domcontentloaded")
+        await readiness.wait(page, "new_comments.scroller", ElementState(".note-scroller"), required=True)
+        while waiter and crawl["pages"] < max_pages:
+            with metrics.span("wait"):
+                captured = await capture.wait(waiter, timeout=5)
+            if captured is None:
+                break
+            crawl["pages"] += 1
+            if classify(flatten_comments(captured.comments)) and mark:
+                crawl["reached_seen"] = True
+                break
+            if not captured.has_more:
+                break
+            waiter = capture.expect(page, "comments")
+            await page.evaluate("""
+                const scroller = document.querySelector('.note-scroller');
+                if (scroller) scroller.scrollTop = scroller.scrollHeight;
+            """)
+        if crawl["pages"]:
+            return
+
+        # 未捕获到评论接口时，采集页面上的评论与已见集合比对（页面数据没有时间，无法按水位提前停止）
+        with metrics.span("extract"):
+            tree = await harvest_comments(page, limit=20 * max_pages, max_expand=0,
+                                          budget_ms=remaining_ms(30000, reserve_ms=1000))
+        flat = []
+        for comment in tree["comments"]:
+            for record, parent_id in [(comment, None)] + [(reply, comment["id"]) for reply in comment["replies"]]:
+                flat.append({**{key: record[key] for key in COMMENT_FIELDS}, "id": record["id"],
+                             "parent_id": parent_id, "created_at": 0})
+        classify(flat)
+        crawl["source"] = "dom"
+
+
+BATCH_FIELDS = {"content", "comments"}
+
+
+@mcp.tool()
+@metrics.timed
+async def get_articles_batch(urls: list[str], fields: Optional[list[str]] = None, concurrency: int = 6,
+                             comment_limit: int = 20, max_expand: int = 5, force_refresh: bool = False,
+                             timeout: Optional[float] = None, ctx: Context = None) -> Dict[str, Any]:
+    """
+    批量获取笔记，在各浏览器的页面池间并行执行，每完成一篇即通过进度通知推送
+    args:
+        urls: 笔记url列表
+        fields: 需要获取的内容，可选 "content"（正文）、"comments"（评论），默认只取正文
+        concurrency: 最大并发数
+        comment_limit: 获取评论时每篇笔记的评论数量
+        max_expand: 获取评论时每条评论最多展开回复的次数
+        force_refresh: 忽略缓存，强制重新获取
+        timeout: 整批的超时（秒），到期时取消未完成的笔记并返回已完成的结果；不填则不限时
+    """
+    fields = fields or ["content"]
+    unknown = set(fields) - BATCH_FIELDS
+    if unknown:
+        return {"success": False, "message": f"不支持的字段: {', '.join(sorted(unknown))}"}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch(url: str) -> Dict[str, Any]:
+        async with semaphore:
             try:
-                await show_more_btn.click()
-                await reply_container.wait_for_selector(".comment-item-sub", timeout=5000)
-                await page.wait_for_timeout(random.randint(1000, 2000))
-                expand_count += 1
-                continue  # 继续处理新加载的
+                result: Dict[str, Any] = {"url": url, "success": True}
+                errors = []
+                if "content" in fields:
+                    content = await get_article_content(url, force_refresh=force_refresh)
+                    if content["success"]:
+                        result.update({key: value for key, value in content.items() if key != "success"})
+                    else:
+                        errors.append(content["message"])
+                if "comments" in fields:
+                    comments = await view_article_comments(url, limit=comment_limit, max_expand=max_expand,
+                                                           force_refresh=force_refresh)
+                    if comments["success"]:
+                        result["comments"] = comments["comments"]
+                    else:
+                        errors.append(comments["message"])
+                if errors:
+                    result.update({"success": False, "message": "; ".join(errors)})
+                return result
             except Exception as e:
-                break
-        break
-    return replies
+                # 单篇的意外异常（如缓存读写出错）只记入该篇结果，不影响其他已完成的笔记
+                return {"url": url, "success": False, "message": f"获取失败: {str(e)}"}
+
+    results: Dict[str, Dict[str, Any]] = {}
+    done = 0
+    tasks: list[asyncio.Task] = []
+    timed_out = False
+    try:
+        async with call_deadline(timeout):
+            # 在截止时间内创建任务，子任务继承截止时间，浏览器侧的等待按剩余时间裁剪
+            tasks = [asyncio.create_task(fetch(url)) for url in urls]
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                results[result["url"]] = result
+                done += 1
+                await report_batch(ctx, done, len(urls), [result])
+    except TimeoutError:
+        timed_out = True
+    finally:
+        # 超时或调用被取消时，取消仍在进行的笔记，其标签页由页面池重置后归还
+        for task in tasks:
+            task.cancel()
+
+    ordered = [results.get(url) or {"url": url, "success": False, "message": f"超时未完成（{timeout}s）"}
+               for url in urls]
+    succeeded = sum(1 for result in ordered if result["success"])
+    return {
+        "success": succeeded > 0 or not urls,
+        "results": ordered,
+        "count": len(ordered),
+        "succeeded": succeeded,
+        "failed": len(ordered) - succeeded,
+        "timed_out": timed_out,
+    }
 
 
 @mcp.tool()
-async def post_comment(article_url: str, comment_text: str) -> Dict[str, Any]:
+@metrics.timed
+async def post_comment(article_url: str, comment_text: str, account: Optional[str] = None,
+                       max_wait: Optional[float] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
     """
     发布笔记评论，对笔记进行评论
     args:
         article_url: 要评论的笔记的url
         comment_text: 评论内容文本
+        account: 指定发布账号（浏览器 id），不填则同一笔记的评论粘滞到同一账号
+        max_wait: 频率限制下最多排队等待的秒数，超过则直接返回失败；不填则排队直到可以发表
+        timeout: 调用超时（秒，含排队时间），超时后中断操作并重置标签页；不填则不限时
     """
+    # 同一笔记的链接带不同的 xsec_token，按笔记 id 粘滞到同一账号
+    affinity_key = f"comment:{note_cache.key(article_url)}"
     try:
-        page = (await preferred_browser()).page
-        await page.goto(article_url, wait_until="domcontentloaded")
-        await page.wait_for_timeout(3000)
-        input_box = await page.query_selector(".input-box .content-edit")
-        if input_box:
-            await input_box.click()
-            await page.wait_for_timeout(1000)
-            comment_input = await page.query_selector(".input-box .content-edit .content-input")
-            if comment_input:
-                await comment_input.fill(comment_text)
-                submit_btn = await page.query_selector("button:has-text('发表'), button:has-text('发送')")
-                if submit_btn:
-                    await submit_btn.click()
-                    await page.wait_for_timeout(3000)
-                    return {
-                        "success": True,
-                        "message": "评论发表成功",
-                        "comment": comment_text
-                    }
-        return {"success": False, "message": "未找到评论输入框或按钮"}
+        async with call_deadline(timeout), leased_page(account, affinity_key=affinity_key,
+                                                       rate_limit="comment", max_wait=max_wait) as page:
+            with metrics.span("navigate"):
+                await page.goto(article_url, wait_until="domcontentloaded")
+            await readiness.wait(page, "comment.input_box", ElementState(".input-box .content-edit"),
+                                 replaces_ms=3000)
+            input_box = await page.query_selector(".input-box .content-edit")
+            if input_box:
+                await input_box.click()
+                await readiness.wait(page, "comment.input", ElementState(".input-box .content-edit .content-input"),
+                                     replaces_ms=1000)
+                comment_input = await page.query_selector(".input-box .content-edit .content-input")
+                if comment_input:
+                    await comment_input.fill(comment_text)
+                    submit_btn = await page.query_selector("button:has-text('发表'), button:has-text('发送')")
+                    if submit_btn:
+                        idle = RouteIdle(page, r"/api/sns/web/v1/comment/post")
+                        await submit_btn.click()
+                        # 等评论接口返回，而不是固定等待
+                        await readiness.wait(page, "comment.submit", idle, replaces_ms=3000)
+                        return {
+                            "success": True,
+                            "message": "评论发表成功",
+                            "comment": comment_text
+                        }
+            return {"success": False, "message": "未找到评论输入框或按钮"}
+    except TimeoutError:
+        return {"success": False, "message": f"评论发表超时（{timeout}s），未确认是否已发表"}
     except Exception as e:
         return {"success": False, "message": f"评论发表失败: {str(e)}"}
 
 
 @mcp.tool()
+@metrics.timed
 async def post_note(title: str, content: str, abstract: Optional[str]=None, tags: Optional[list[str]] = None,
-                    image: Optional[list[Union[pathlib.Path, str]]] = None) -> Dict[str, Any]:
+                    image: Optional[list[Union[pathlib.Path, str]]] = None,
+                    account: Optional[str] = None, max_wait: Optional[float] = None,
+                    compress_images: bool = True, timeout: Optional[float] = None) -> Dict[str, Any]:
     """
     发布笔记
     args:
@@ -456,36 +2722,245 @@ async def post_note(title: str, content: str, abstract: Optional[str]=None, tags
         content: 笔记正文（正文最后不包含笔记标签）
         tags: 笔记话题标签
         image: 笔记配图，非必填但图片和摘要二选一
+        account: 指定发布账号（浏览器 id），不填则由调度器选择
+        max_wait: 频率限制下最多排队等待的秒数，超过则直接返回失败；不填则排队直到可以发布
+        compress_images: 是否在上传前压缩配图，为 false 时按原图上传（截图等需要保留原画质时使用）
+        timeout: 调用超时（秒，含排队与图片下载时间），超时后中断操作并重置标签页；不填则不限时
     """
+    prefetch = None
     try:
-        page = (await preferred_browser()).page
-        await page.goto("https://creator.xiaohongshu.com/publish/publish?source=official")
-        await page.wait_for_selector('.upload-container')
+        # 图片在打开创作页的同时并发下载
+        prefetch = asyncio.create_task(image_fetcher.prefetch(image, compress_images)) if image else None
+        async with call_deadline(timeout), leased_page(account, rate_limit="note", max_wait=max_wait) as page:
+            with metrics.span("navigate"):
+                await page.goto("https://creator.xiaohongshu.com/publish/publish?source=official")
+            await readiness.wait(page, "note.upload_container", ElementState(".upload-container"), required=True)
+
+            result = {"success": True, "message": "笔记发布成功", "title": title}
+            if image:
+                with metrics.span("download"):
+                    files = await prefetch
+                await post_image_text_note(page, title, content, tags, image, files=files)
+                result["image_transfer"] = image_fetcher.transfer_report(files)
+            else:
+                await post_text_note(page, title, abstract, content, tags)
+
+            await page.goto("https://www.xiaohongshu.com", wait_until="commit")
+
+            return result
+    except TimeoutError:
+        return {"success": False, "message": f"发布笔记超时（{timeout}s），未确认是否已发布"}
+    except Exception as e:
+        print(e)
+        return {"success": False, "message": f"发布笔记失败: {str(e)}"}
+    finally:
+        if prefetch and not prefetch.done():
+            prefetch.cancel()
 
-        if image:
-            await post_image_text_note(title, content, tags, image)
-        else:
-            await post_text_note(title, abstract, content, tags)
 
-        await page.goto("https://www.xiaohongshu.com", wait_until="commit")
+class PublishQueue:
+    """
+    笔记发布任务队列，任务持久化到 SQLite，重启后排队中的任务继续执行
+    每个浏览器一个 worker 依次取出任务发布，指定账号的任务只由对应浏览器执行
+    发布不是幂等的，上次运行中断在执行中的任务标记为 interrupted，由人工确认是否已发布，不再自动重发
+    """
 
-        return {"success": True, "message": "笔记发布成功", "title": title}
+    def __init__(self, path: Union[str, Path], idle_poll: float = 10, unavailable_backoff: float = 30):
+        self.idle_poll = idle_poll
+        self.unavailable_backoff = unavailable_backoff
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._cond: Optional[asyncio.Condition] = None
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS publish_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                account TEXT,
+                browser TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                result TEXT
+            )
+        """)
+        self.db.commit()
+
+    def _recover_interrupted(self):
+        """把上次运行中断在执行中的任务标记为 interrupted；只在服务进程首次启动队列时执行，导入模块时不做任何修改"""
+        result = json.dumps({
+            "success": False,
+            "message": "服务在发布过程中中断，可能已经发布，请人工确认后再决定是否重新提交",
+        }, ensure_ascii=False)
+        cursor = self.db.execute(
+            "UPDATE publish_jobs SET status = 'interrupted', finished_at = ?, result = ? WHERE status = 'running'",
+            (time.time(), result)
+        )
+        self.db.commit()
+        if cursor.rowcount:
+            print(f"发布队列有 {cursor.rowcount} 个任务在上次运行中中断，已标记为 interrupted，请人工确认")
+
+    def start(self):
+        """为每个浏览器启动 worker，重复调用无副作用"""
+        if self._cond is None:
+            # 首次启动时本进程还没有执行中的任务，此时处于 running 的都是上次运行遗留的
+            self._recover_interrupted()
+            self._cond = asyncio.Condition()
+        for browser_id in browsers:
+            worker = self._workers.get(browser_id)
+            if worker is None or worker.done():
+                self._workers[browser_id] = asyncio.create_task(self._worker(browser_id))
+
+    async def submit(self, params: Dict[str, Any], account: Optional[str] = None) -> str:
+        if account and account not in browsers:
+            raise RuntimeError(f"未知账号: {account}")
+        job_id = uuid.uuid4().hex[:12]
+        self.db.execute(
+            "INSERT INTO publish_jobs (id, status, params, account, created_at) VALUES (?, 'queued', ?, ?, ?)",
+            (job_id, json.dumps(params, ensure_ascii=False), account, time.time())
+        )
+        self.db.commit()
+        self.start()
+        async with self._cond:
+            self._cond.notify_all()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self.db.execute("SELECT * FROM publish_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        if job["status"] == "queued":
+            job["position"] = self.db.execute(
+                "SELECT COUNT(*) FROM publish_jobs WHERE status = 'queued' AND created_at <= ?", (job["created_at"],)
+            ).fetchone()[0]
+        return job
+
+    def _claim(self, browser_id: str) -> Optional[Dict[str, Any]]:
+        # 查询与更新之间没有 await，在单事件循环内是原子的
+        row = self.db.execute("""
+            SELECT id, params FROM publish_jobs
+            WHERE status = 'queued' AND (account IS NULL OR account = ?)
+            ORDER BY created_at LIMIT 1
+        """, (browser_id,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE publish_jobs SET status = 'running', browser = ?, started_at = ? WHERE id = ?",
+                        (browser_id, time.time(), row["id"]))
+        self.db.commit()
+        return {"id": row["id"], "params": json.loads(row["params"])}
+
+    def _finish(self, job_id: str, result: Dict[str, Any]):
+        self.db.execute("UPDATE publish_jobs SET status = ?, finished_at = ?, result = ? WHERE id = ?",
+                        ("succeeded" if result.get("success") else "failed", time.time(),
+                         json.dumps(result, ensure_ascii=False), job_id))
+        self.db.commit()
+
+    async def _worker(self, browser_id: str):
+        available = True
+        while True:
+            try:
+                # 浏览器不可用或未登录时不领取任务，留给其他浏览器
+                await preferred_browser(account=browser_id)
+                available = True
+            except Exception as e:
+                if available:
+                    print(f"发布队列 {browser_id} 暂不可用: {str(e)}")
+                available = False
+                await asyncio.sleep(self.unavailable_backoff)
+                continue
+            job = self._claim(browser_id)
+            if job is None:
+                async with self._cond:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), self.idle_poll)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            print(f"发布队列 {browser_id} 开始执行任务 {job['id']}")
+            try:
+                result = await post_note(**job["params"], account=browser_id)
+            except Exception as e:
+                result = {"success": False, "message": f"发布笔记失败: {str(e)}"}
+            self._finish(job["id"], result)
+
+
+publish_queue = PublishQueue(Path(__file__).resolve().parent / "xiaohongshu_jobs.sqlite3")
+
+
+@mcp.tool()
+@metrics.timed
+async def submit_note(title: str, content: str, abstract: Optional[str] = None, tags: Optional[list[str]] = None,
+                      image: Optional[list[str]] = None, account: Optional[str] = None,
+                      compress_images: bool = True) -> Dict[str, Any]:
+    """
+    提交笔记发布任务，立即返回任务 id，由后台队列发布，用 job_status / job_result 查询进度与结果
+    args:
+        title: 笔记标题，必填，最长20个字
+        abstract: 笔记摘要，归纳笔记要点，列表形式每行一条，非必填但图片和摘要二选一
+        content: 笔记正文（正文最后不包含笔记标签）
+        tags: 笔记话题标签
+        image: 笔记配图（本地路径或 url），非必填但图片和摘要二选一
+        account: 指定发布账号（浏览器 id），不填则由任一可用浏览器发布
+        compress_images: 是否在上传前压缩配图，为 false 时按原图上传
+    """
+    try:
+        params = {"title": title, "content": content, "abstract": abstract, "tags": tags,
+                  "image": [str(i) for i in image] if image else None, "compress_images": compress_images}
+        job_id = await publish_queue.submit(params, account)
+        return {"success": True, "job_id": job_id, "status": "queued"}
     except Exception as e:
-        print(e)
-        return {"success": False, "message": f"发布笔记失败: {str(e)}"}
+        return {"success": False, "message": f"提交发布任务失败: {str(e)}"}
+
+
+@mcp.tool()
+@metrics.timed
+async def job_status(job_id: str) -> Dict[str, Any]:
+    """
+    查询发布任务状态（queued / running / succeeded / failed / interrupted）
+    interrupted 表示服务在发布过程中中断，可能已经发布，需要人工确认
+    args:
+        job_id: submit_note 返回的任务 id
+    """
+    job = publish_queue.get(job_id)
+    if job is None:
+        return {"success": False, "message": f"任务不存在: {job_id}"}
+    status = {key: job[key] for key in ("status", "account", "browser", "created_at", "started_at", "finished_at")}
+    if "position" in job:
+        status["position"] = job["position"]
+    return {"success": True, "job_id": job_id, **status}
+
+
+@mcp.tool()
+@metrics.timed
+async def job_result(job_id: str) -> Dict[str, Any]:
+    """
+    获取发布任务结果，任务未完成时返回当前状态
+    args:
+        job_id: submit_note 返回的任务 id
+    """
+    job = publish_queue.get(job_id)
+    if job is None:
+        return {"success": False, "message": f"任务不存在: {job_id}"}
+    if job["status"] in ("queued", "running"):
+        return {"success": False, "job_id": job_id, "status": job["status"], "message": "任务尚未完成"}
+    return {"success": True, "job_id": job_id, "status": job["status"], "result": job["result"]}
 
 
 async def human_wait(page, min_ms: int = 500, max_ms: int = 1000):
     base = 200
     delay = random.randint(min_ms, max_ms) + base
-    await page.wait_for_timeout(delay)
+    with metrics.span("wait"):
+        await page.wait_for_timeout(delay)
 
 
-async def post_text_note(title: str, abstract: str, content: str, tags: Optional[list[str]] = None):
-    page = (await preferred_browser()).page
+async def post_text_note(page: Page, title: str, abstract: str, content: str, tags: Optional[list[str]] = None):
     # 选择纯文本
     await page.locator('.upload-container .creator-tab:has-text("写长文"):not([style])').click()
-    await page.wait_for_selector('.new-btn', timeout=20000)
+    await readiness.wait(page, "note.new_button", ElementState(".new-btn"), required=True)
     # 进入编辑
     await page.locator('.new-btn').click()
     await human_wait(page)
@@ -498,13 +2973,13 @@ async def post_text_note(title: str, abstract: str, content: str, tags: Optional
     # 下一步
     await page.locator(".next-btn", has_text="一键排版").click()
     # 等待生成图片页面加载完成
-    await page.wait_for_selector(".loading-card")
-    await page.locator(".loading-card").first.wait_for(state="detached", timeout=30000)
+    await readiness.wait(page, "note.layout", ElementState(".loading-card", "attached"),
+                         ElementState(".loading-card", "detached"), required=True)
     await human_wait(page)
     # 下一步进入图文
     await page.locator(".footer .submit").click()
     # 等待图片页面加载完成
-    await page.wait_for_selector(".post-page")
+    await readiness.wait(page, "note.post_page", ElementState(".post-page"), required=True)
     # 填写正文
     await page.fill('.edit-container .ProseMirror', content)
     await human_wait(page)
@@ -527,20 +3002,24 @@ async def post_text_note(title: str, abstract: str, content: str, tags: Optional
     # 发布
     await human_wait(page)
     await page.get_by_text("发布", exact=True).click()
-    await page.get_by_text("发布成功").wait_for(state="visible")
+    await readiness.wait(page, "note.published", ElementState("text=发布成功"), required=True)
 
 
-async def post_image_text_note(title: str, content: str, tags: Optional[list[str]] = None,
-                               image: Optional[list[Union[pathlib.Path, str]]] = None):
-    page = (await preferred_browser()).page
+async def post_image_text_note(page: Page, title: str, content: str, tags: Optional[list[str]] = None,
+                               image: Optional[list[Union[pathlib.Path, str]]] = None,
+                               files: Optional[list[Optional[Path]]] = None):
+    if files is None:
+        files = await image_fetcher.prefetch(image)
+    if not files[0]:
+        raise Exception(f"上传第一张图片失败：{image[0]}")
     # 选择图文
     await page.locator('.upload-container .creator-tab:has-text("上传图文"):not([style])').click()
-    await page.wait_for_selector(".upload-input", timeout=20000)
+    await readiness.wait(page, "note.upload_input", ElementState(".upload-input"), required=True)
     # 上传图片
     await human_wait(page)
-    await upload_image_first(image[0])
-    if len(image) > 1:
-        await upload_image(image[1:])
+    await upload_image_first(page, files[0])
+    if len(files) > 1:
+        await upload_image(page, files[1:])
     # 填写标题
     await page.fill('input[placeholder="填写标题会有更多赞哦～"]', title)
     await human_wait(page)
@@ -566,78 +3045,326 @@ async def post_image_text_note(title: str, content: str, tags: Optional[list[str
     # 发布
     await human_wait(page)
     await page.get_by_text("发布", exact=True).click()
-    await page.get_by_text("发布成功").wait_for(state="visible")
-
+    await readiness.wait(page, "note.published", ElementState("text=发布成功"), required=True)
 
-async def upload_image_first(image: Union[pathlib.Path, str]):
-    page = (await preferred_browser()).page
-    file_payload = await get_file(image)
-    if not file_payload:
-        raise Exception(f"上传第一张图片失败：{image}")
-    # 监听文件选择器弹出
-    async with page.expect_file_chooser() as fc_info:
-        await page.locator('.upload-input').click()
-    file_chooser = await fc_info.value
-    await file_chooser.set_files(file_payload)
 
-    # 等待上传完成
-    await human_wait(page,min_ms=1000, max_ms=2000)
+async def upload_image_first(page: Page, file: Path):
+    with metrics.span("upload"):
+        # 监听文件选择器弹出
+        async with page.expect_file_chooser() as fc_info:
+            await page.locator('.upload-input').click()
+        file_chooser = await fc_info.value
+        await file_chooser.set_files(file)
 
-    # 等待跳转
-    await page.wait_for_selector(".post-page")
+    # 上传完成后页面跳转到编辑页
+    await readiness.wait(page, "note.first_upload", ElementState(".post-page"), replaces_ms=1700, required=True)
     await human_wait(page)
 
 
-async def get_file(file: Union[str, pathlib.Path]):
-    try:
-        if isinstance(file, pathlib.Path):
-            file_name = file.name
-            with open(file, "rb") as f:
-                file_byte = f.read()
-        elif isinstance(file, str) and not file.startswith("http"):
-            with open(file, "rb") as f:
-                file_byte = f.read()
-            file_name = os.path.basename(file)
-        elif isinstance(file, str) and file.startswith("http"):
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file, timeout=10) as resp:
-                    if resp.status == 200:
-                        file_byte = await resp.read()
-            file_name = os.path.basename(unquote(urlparse(file).path))
-        else:
+def _recompress_image(source: str, target: str, max_side: int, quality: int, fmt: str) -> int:
+    """在子进程中执行：按 EXIF 方向摆正、缩放到最长边 max_side、去除 EXIF 后重新编码，返回输出字节数"""
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        if fmt == "JPEG" and img.mode != "RGB":
+            # JPEG 不支持透明通道，铺白底
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A") if "A" in img.getbands() else None)
+            img = background
+        img.save(target, fmt, quality=quality, optimize=True)
+    return os.path.getsize(target)
+
+
+# JPEG 中携带元数据的段：APP1（EXIF/XMP，含 GPS）、APP13（IPTC）
+JPEG_METADATA_MARKERS = {0xE1, 0xED}
+
+
+def _strip_image_metadata(source: str, target: str) -> Optional[int]:
+    """
+    在子进程中执行：不改动像素，只去掉原图的 EXIF（含 GPS）等元数据，返回输出字节数；
+    EXIF 方向不是默认值（去掉后图片会转向）或格式不支持时返回 None
+    """
+    with Image.open(source) as img:
+        if img.getexif().get(0x0112, 1) != 1 or img.format not in ("JPEG", "PNG", "WEBP"):
             return None
+        if img.format != "JPEG":
+            # PNG/WebP 只有显式传入 exif 时才会写入元数据，无损重新保存即可去掉
+            img.save(target, img.format, **({"lossless": True} if img.format == "WEBP" else {}))
+            return os.path.getsize(target)
+    # JPEG 逐段复制，跳过元数据段，压缩数据原样保留
+    data = Path(source).read_bytes()
+    out = bytearray(data[:2])
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF and data[i + 1] != 0xDA:
+        end = i + 2 + int.from_bytes(data[i + 2:i + 4], "big")
+        if data[i + 1] not in JPEG_METADATA_MARKERS:
+            out += data[i:end]
+        i = end
+    out += data[i:]
+    Path(target).write_bytes(out)
+    return len(out)
+
+
+class ImagePreprocessor:
+    """
+    上传前在进程池中压缩图片，减少经 CDP 传给远程浏览器的数据量
+    缩放到平台最大有效分辨率、去除 EXIF 并按质量参数重新编码；结果不比原图小时，改为无损去除原图的元数据后上传
+    """
 
-        if kind := filetype.guess(file_byte):
-            mime_type = kind.mime
-        elif mime_types := mimetypes.guess_type(file_name):
-            mime_type, _ = mime_types
-        else:
-            mime_type = "application/octet-stream"
-        file = {
-            "name": file_name,
-            "mimeType": mime_type,
-            "buffer": file_byte
+    FORMATS = {"jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp")}
+
+    def __init__(self, output_dir: Path, max_side: int = 2048, quality: int = 85, fmt: str = "jpeg",
+                 workers: int = 2):
+        self.output_dir = output_dir
+        self.max_side = max_side
+        self.quality = quality
+        self.fmt, self.ext = self.FORMATS[fmt]
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def process(self, source: Path) -> tuple[Path, Dict[str, Any]]:
+        """返回实际上传的文件与本次处理报告"""
+        start = time.perf_counter()
+        original = source.stat().st_size
+        report = {"original_bytes": original, "transferred_bytes": original, "ms": 0.0, "recompressed": False,
+                  "exif_stripped": False}
+        if Image is None or source.suffix.lower() == ".gif":
+            return source, report
+        stat = source.stat()
+        key = f"{source.resolve()}|{stat.st_mtime_ns}|{original}|{self.max_side}|{self.quality}|{self.fmt}"
+        target = self.output_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.{self.ext}"
+        try:
+            size = await self._run(target, _recompress_image, str(source), str(target), self.max_side, self.quality,
+                                   self.fmt)
+            recompressed = size < original
+            if not recompressed:
+                # 重新编码没有变小：上传原图，但先无损去掉 EXIF/GPS；做不到时仍用重新编码的结果
+                digest = hashlib.sha1(f"{key}|strip".encode()).hexdigest()
+                stripped = self.output_dir / f"{digest}{source.suffix.lower()}"
+                stripped_size = await self._run(stripped, _strip_image_metadata, str(source), str(stripped))
+                if stripped_size is not None:
+                    target, size = stripped, stripped_size
+                else:
+                    recompressed = True
+        except Exception as e:
+            print(f"图片压缩失败，使用原图（未去除 EXIF）: {source} {str(e)}")
+            return source, report
+        report.update({"ms": round((time.perf_counter() - start) * 1000, 1), "transferred_bytes": size,
+                       "recompressed": recompressed, "exif_stripped": True})
+        return target, report
+
+    async def _run(self, output: Path, fn, *args) -> Optional[int]:
+        """输出文件已存在（同一源文件与参数处理过）时直接复用，否则在进程池中执行 fn"""
+        if output.exists():
+            return output.stat().st_size
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class ImageFetcher:
+    """
+    笔记配图预取：共享连接池并发下载，流式写入本地缓存目录而不是整块读入内存
+    缓存按内容哈希命名，并记录 url -> 文件 的索引，重复使用的图片无需再次下载
+    """
+
+    def __init__(self, cache_dir: Path, max_image_bytes: int = 20 * 1024 * 1024,
+                 max_cache_bytes: int = 512 * 1024 * 1024, concurrency: int = 4,
+                 preprocessor: Optional[ImagePreprocessor] = None):
+        self.cache_dir = cache_dir
+        self.preprocessor = preprocessor
+        self.reports: Dict[Path, Dict[str, Any]] = {}
+        self.max_image_bytes = max_image_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.concurrency = concurrency
+        self.index_file = cache_dir / "index.json"
+        self._index: Optional[Dict[str, str]] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.stats = {"downloads": 0, "cache_hits": 0, "failures": 0, "bytes_downloaded": 0}
+
+    def _load_index(self) -> Dict[str, str]:
+        if self._index is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                self._index = json.loads(self.index_file.read_text())
+            except Exception:
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        self.index_file.write_text(json.dumps(self._index, ensure_ascii=False))
+
+    def _session_get(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency * 2),
+                timeout=aiohttp.ClientTimeout(total=60, sock_connect=10),
+            )
+        return self._session
+
+    async def prefetch(self, files: list[Union[str, pathlib.Path]], preprocess: bool = True) -> list[Optional[Path]]:
+        """
+        并发解析/下载全部图片，返回与输入一一对应的本地路径（失败为 None）
+        args:
+            files: 本地路径或 url
+            preprocess: 是否经预处理器压缩，未配置预处理器时忽略
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_one(file):
+            async with semaphore:
+                return await self.fetch(file, preprocess)
+
+        return list(await asyncio.gather(*(fetch_one(file) for file in files)))
+
+    async def fetch(self, file: Union[str, pathlib.Path], preprocess: bool = True) -> Optional[Path]:
+        path = await self._resolve(file)
+        if path and preprocess and self.preprocessor:
+            path, report = await self.preprocessor.process(path)
+            self.reports[path] = report
+            print(f"图片预处理: {file} {report['original_bytes']} -> {report['transferred_bytes']} 字节，"
+                  f"耗时 {report['ms']}ms")
+        return path
+
+    def transfer_report(self, files: list[Optional[Path]]) -> Dict[str, Any]:
+        """汇总一次上传中各图片的原始字节数、实际传输字节数与预处理耗时"""
+        reports = [self.reports[file] for file in files if file in self.reports]
+        return {
+            "images": len(reports),
+            "original_bytes": sum(r["original_bytes"] for r in reports),
+            "transferred_bytes": sum(r["transferred_bytes"] for r in reports),
+            "preprocess_ms": round(sum(r["ms"] for r in reports), 1),
+            # 未去除 EXIF 的图片数（GIF、未安装 Pillow 或处理失败时按原图上传）
+            "exif_kept": sum(1 for r in reports if not r["exif_stripped"]),
         }
-        return file
-    except Exception as e:
-        print(e)
-        return None
 
+    async def _resolve(self, file: Union[str, pathlib.Path]) -> Optional[Path]:
+        try:
+            if isinstance(file, str) and file.startswith("http"):
+                return await self._download(file)
+            if isinstance(file, (str, pathlib.Path)):
+                path = Path(file)
+                if not path.is_file() or path.stat().st_size > self.max_image_bytes:
+                    print(f"图片不存在或超过大小限制: {file}")
+                    return None
+                if mimetypes.guess_type(path.name)[0]:
+                    return path
+                # 本地文件无法从扩展名判断类型时，按内容复制到缓存并补全扩展名
+                data = path.read_bytes()
+                return self._store(hashlib.sha256(data).hexdigest(), data[:512], path)
+            return None
+        except Exception as e:
+            self.stats["failures"] += 1
+            print(f"获取图片失败: {file} {str(e)}")
+            return None
 
-async def upload_image(images: list[Union[pathlib.Path, str]]) -> Optional[str]:
+    async def _download(self, url: str) -> Optional[Path]:
+        index = self._load_index()
+        cached = index.get(url)
+        if cached and (self.cache_dir / cached).is_file():
+            self.stats["cache_hits"] += 1
+            os.utime(self.cache_dir / cached)
+            return self.cache_dir / cached
+
+        part = self.cache_dir / f".{os.getpid()}-{id(url)}-{time.monotonic_ns()}.part"
+        digest = hashlib.sha256()
+        head = b""
+        size = 0
+        try:
+            async with self._session_get().get(url) as resp:
+                if resp.status != 200:
+                    raise Exception(f"HTTP {resp.status}")
+                if resp.content_length and resp.content_length > self.max_image_bytes:
+                    raise Exception(f"图片超过大小限制: {resp.content_length} 字节")
+                with open(part, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        size += len(chunk)
+                        if size > self.max_image_bytes:
+                            raise Exception(f"图片超过大小限制: >{self.max_image_bytes} 字节")
+                        if len(head) < 512:
+                            head += chunk[:512 - len(head)]
+                        digest.update(chunk)
+                        f.write(chunk)
+        except Exception:
+            part.unlink(missing_ok=True)
+            raise
+        self.stats["downloads"] += 1
+        self.stats["bytes_downloaded"] += size
+        path = self._store(digest.hexdigest(), head, part, url=url)
+        index[url] = path.name
+        self._save_index()
+        self._prune()
+        return path
+
+    def _store(self, content_hash: str, head: bytes, source: Path, url: Optional[str] = None) -> Path:
+        """按内容哈希落盘，同一内容只保存一份"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if kind := filetype.guess(head):
+            ext = kind.extension
+        else:
+            ext = Path(unquote(urlparse(url).path)).suffix.lstrip(".") if url else source.suffix.lstrip(".")
+        target = self.cache_dir / f"{content_hash}.{ext or 'bin'}"
+        if target.exists():
+            if url:
+                source.unlink(missing_ok=True)
+        elif url:
+            os.replace(source, target)
+        else:
+            shutil.copyfile(source, target)
+        return target
+
+    def _prune(self):
+        """缓存目录超出容量时按最近使用时间淘汰"""
+        files = [p for p in self.cache_dir.rglob("*") if p.is_file() and p != self.index_file
+                 and not p.name.startswith(".")]
+        total = sum(p.stat().st_size for p in files)
+        if total <= self.max_cache_bytes:
+            return
+        for path in sorted(files, key=lambda p: p.stat().st_mtime):
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+            if total <= self.max_cache_bytes:
+                break
+        self._index = {url: name for url, name in self._index.items() if (self.cache_dir / name).exists()}
+        self._save_index()
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self.preprocessor:
+            self.preprocessor.close()
+
+
+# 上传前是否在进程池中压缩配图（缩放、去除 EXIF、重新编码）；关闭或未安装 Pillow 时按原图上传
+IMAGE_PREPROCESS = True
+
+image_fetcher = ImageFetcher(
+    Path(__file__).resolve().parent / "image_cache",
+    preprocessor=ImagePreprocessor(Path(__file__).resolve().parent / "image_cache" / "processed")
+    if IMAGE_PREPROCESS else None,
+)
+
+
+async def upload_image(page: Page, files: list[Optional[Path]]) -> Optional[str]:
     try:
-        page = (await preferred_browser()).page
-        for image in images:
+        for file in files:
             await human_wait(page)
-            file_payload = await get_file(image)
-            if not file_payload:
+            if not file:
                 continue
 
-            # 监听文件选择器弹出
-            async with page.expect_file_chooser() as fc_info:
-                await page.locator('.img-upload-area .entry').click()
-            file_chooser = await fc_info.value
-            await file_chooser.set_files(file_payload)
+            with metrics.span("upload"):
+                # 监听文件选择器弹出
+                async with page.expect_file_chooser() as fc_info:
+                    await page.locator('.img-upload-area .entry').click()
+                file_chooser = await fc_info.value
+                await file_chooser.set_files(file)
 
             # 等待上传完成
             await human_wait(page,min_ms=1000, max_ms=2000)
@@ -647,13 +3374,148 @@ async def upload_image(images: list[Union[pathlib.Path, str]]) -> Optional[str]:
 
 
 @mcp.tool()
+@metrics.timed
 async def close_browser() -> Dict[str, Any]:
     return await clean_browsers()
 
 
+@mcp.tool()
+@metrics.timed
+async def browser_status() -> Dict[str, Any]:
+    """查看各浏览器的连接、CDP 端点探测、页面池（池大小、占用、等待时间、耗尽次数、各页面导航次数/JS 堆/DOM 节点与回收次数）、调度负载与只读工具的资源拦截统计"""
+    status = {}
+    for browser_id, browser in browsers.items():
+        status[browser_id] = {
+            "cdp_url": browser.cdp_url,
+            "connected": bool(browser.browser and browser.browser.is_connected()),
+            "endpoint": cdp_prober.status(browser.cdp_url),
+            "logged_in": browser.is_logged_in,
+            "pool": browser.pool.status() if browser.pool else None,
+            "capture": browser.capture.status() if browser.capture else None,
+            "load": scheduler.status()[browser_id],
+            "rate_limits": rate_limiter.status(browser_id),
+        }
+    return {"success": True, "browsers": status, "resource_blocking": ResourceBlocker.totals}
+
+
+@mcp.tool()
+@metrics.timed
+async def set_recycle_policy(browser_id: str, max_navigations: Optional[int] = None,
+                             max_heap_mb: Optional[float] = None, max_dom_nodes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    调整某个浏览器的标签页回收阈值，页面下次归还时按新阈值判定；当前采样值见 browser_status 的 pool.pages
+    args:
+        browser_id: 浏览器 id
+        max_navigations: 单个页面最多导航次数，0 表示不限制，不填则保持当前值
+        max_heap_mb: 单个页面 JS 堆上限（MB），0 表示不限制，不填则保持当前值
+        max_dom_nodes: 单个页面 DOM 节点数上限，0 表示不限制，不填则保持当前值
+    """
+    browser = browsers.get(browser_id)
+    if browser is None:
+        return {"success": False, "message": f"未知浏览器: {browser_id}"}
+    for name, value in (("max_navigations", max_navigations), ("max_heap_mb", max_heap_mb),
+                        ("max_dom_nodes", max_dom_nodes)):
+        if value is not None:
+            if value < 0:
+                return {"success": False, "message": f"{name} 不能为负数"}
+            setattr(browser.recycle, name, value)
+    return {"success": True, "browser_id": browser_id, "policy": asdict(browser.recycle)}
+
+
+@mcp.tool()
+@metrics.timed
+async def cache_status() -> Dict[str, Any]:
+    """查看笔记内容/评论缓存的命中、未命中、过期、淘汰次数与当前条目数"""
+    return {"success": True, "cache": note_cache.status()}
+
+
+@mcp.tool(name="metrics")
+async def metrics_status() -> Dict[str, Any]:
+    """
+    查看各工具按浏览器、阶段（select/login/rate_limit/navigate/wait/extract/download/upload/total）统计的耗时分位数与失败次数，
+    以及各就绪等待点的实际耗时、超时次数和相对原固定等待节省的时间
+    """
+    return {"success": True, "tools": metrics.snapshot(), "readiness": readiness.status()}
+
+
+def render_page_metrics() -> str:
+    """各浏览器页面池的采样峰值与回收次数，Prometheus 文本格式"""
+    pools = {browser_id: browser.pool.status() for browser_id, browser in sorted(browsers.items()) if browser.pool}
+    lines = []
+    for metric, key, help_text in (("xhs_page_js_heap_mb", "heap_mb", "当前页面 JS 堆已用大小的最大值（MB）"),
+                                   ("xhs_page_dom_nodes", "dom_nodes", "当前页面 DOM 节点数的最大值"),
+                                   ("xhs_page_navigations", "navigations", "当前页面导航次数的最大值")):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        for browser_id, status in pools.items():
+            lines.append(f'{metric}{{browser="{browser_id}"}} {max((p[key] for p in status["pages"]), default=0)}')
+    lines += [
+        "# HELP xhs_page_recycled_total 按原因统计的页面回收次数",
+        "# TYPE xhs_page_recycled_total counter",
+    ]
+    for browser_id, status in pools.items():
+        for reason, n in status["recycled"].items():
+            lines.append(f'xhs_page_recycled_total{{browser="{browser_id}",reason="{reason}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def prometheus_metrics(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(metrics.render() + render_page_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@mcp.tool()
+async def set_tracing(enabled: bool, slow_ms: Optional[float] = None) -> Dict[str, Any]:
+    """
+    开启或关闭工具调用的 Playwright trace 录制，只保留耗时超过阈值或出错的调用
+    args:
+        enabled: 是否开启录制
+        slow_ms: 耗时阈值（毫秒），不填则保持当前值
+    """
+    tracer.enabled = enabled
+    if slow_ms is not None:
+        tracer.slow_ms = slow_ms
+    return {"success": True, "tracing": tracer.status()}
+
+
+@mcp.tool()
+async def list_traces() -> Dict[str, Any]:
+    """列出已保存的 trace：工具、浏览器、耗时、错误与各阶段耗时，按时间从新到旧"""
+    traces = tracer.list()
+    return {"success": True, "tracing": tracer.status(), "traces": traces, "count": len(traces)}
+
+
+@mcp.tool()
+async def download_trace(trace_id: str) -> Dict[str, Any]:
+    """
+    下载 trace 文件（base64 编码的 zip），可用 npx playwright show-trace 打开
+    trace 的网络记录包含账号 cookie（web_session），不要外传
+    args:
+        trace_id: list_traces 返回的 id
+    """
+    path = tracer.path_of(trace_id)
+    if not path:
+        return {"success": False, "message": f"trace 不存在: {trace_id}"}
+    return {
+        "success": True,
+        "trace_id": trace_id,
+        "filename": path.name,
+        "size": path.stat().st_size,
+        "content_base64": base64.b64encode(path.read_bytes()).decode(),
+    }
+
+
+async def serve():
+    # 服务启动时并发预热浏览器、启动 CDP 健康探测，并拉起发布队列，恢复上次未完成的任务
+    warm_up = asyncio.create_task(warm_up_browsers())
+    cdp_prober.start(browsers)
+    publish_queue.start()
+    await mcp.run_streamable_http_async()
+    warm_up.cancel()
+
+
 # """
 if __name__ == "__main__":
-    mcp.run(transport='streamable-http')
+    asyncio.run(serve())
     # mcp.run(transport='stdio')
 # """
 
@@ -670,7 +3532,6 @@ async def call_tool(arg: str):
         start = time.perf_counter()
         # result = await client.call_tool("login")
         # result = await client.call_tool("search_articles", {"keyword": arg})
-        # result = await client.call_tool("get_current_page_articles")
         result = await client.call_tool("get_article_content", {"article_url":"https://bot.sannysoft.com"})
         # result = await client.call_tool("view_article_comments", {"article_url": "https://www.xiaohongshu.com/explore/67acaee3000000002903b9d3?xsec_token=ABgLq7EQbQbcqWZ3ZJEOv98WyaGPw3wkBIQ1WosKHNoCE=&xsec_source=pc_search&source=unknown", "limit": 10})
         # result = await client.call_tool("post_note",{"title": "✨今日运势指南｜你的专属幸运日✨","content": "🌟今日整体运势：\n今天会是充满机遇的一天！宇宙能量特别眷顾你，适合尝试新事物或做出重要决定。\n\n💖爱情运势：\n单身的朋友可能会遇到心动瞬间，有伴侣的记得给TA一个小惊喜～\n\n💰财运：\n有意外之财的可能，但也要理性消费哦！\n\n⚡幸运物：\n银色饰品能为你带来好运\n\n#今日运势 #星座运势 #好运来","tags": ["今日运势","星座运势","好运来"],"image": []})